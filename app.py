@@ -1,23 +1,76 @@
 import os
 import logging
+import imaplib
 from modules import db
 from modules import smtp
 from modules import logger
+from modules import openWeatherHelper
+from modules import imapHelper
+from modules import metrics
+from modules import subscriptions
+from modules import profiler
+from modules import prefetch
+from modules import upstream
 import threading
 import time
 
 # Interval Configuration
-interval = int(os.getenv('INTERVAL', '60'))
+fetch_mode = os.getenv('FETCH_MODE', 'idle').lower()  # idle or poll
+interval = int(os.getenv('INTERVAL', '60'))  # Longest wait between polls
+min_interval = int(os.getenv('MIN_INTERVAL', '10'))  # Shortest wait between polls while busy
+idle_timeout = int(os.getenv('IDLE_TIMEOUT', '1500'))  # Refresh IDLE before the server's 30 minute limit
+reconnect_delay = int(os.getenv('RECONNECT_DELAY', '30'))
 
-#Function to repeat email fetch on interval
-def run_interval(interval):
+#Function to hold one IMAP session and wait for new mail with IDLE, or adaptive polling if IDLE is not available
+def watch_mailbox():
     while True:
-        smtp.fetch_emails()
-        time.sleep(interval)
+        try:
+            with smtp.connect_imap() as mail:
+                use_idle = fetch_mode == 'idle' and imapHelper.supports_idle(mail)
+                logger.logger.info(f"Watching mailbox using {'IDLE' if use_idle else 'adaptive polling'}")
+                delay = min_interval
+                while True:
+                    with profiler.cycle():
+                        found = smtp.fetch_emails(mail)
+                    if found is None:
+                        mail.noop()  # Raises if the session was lost so we reconnect
+                    if use_idle:
+                        # Mail that arrived during the cycle was announced in a reply to one of its commands and is
+                        # not announced again once IDLE starts, so search again until nothing new came in
+                        if imapHelper.new_mail_pending(mail):
+                            continue
+                        # Emails left unread by the last cycle are not announced again, so come back for them
+                        # once an open circuit could have closed instead of at the end of the IDLE timeout
+                        imapHelper.idle_wait(mail, min(idle_timeout, upstream.circuit_reset) if smtp.retry_pending else idle_timeout)
+                    else:
+                        # Back off while the inbox is quiet, tighten up again while it is busy
+                        delay = min_interval if found else min(delay * 2, interval)
+                        time.sleep(delay)
+        except (imaplib.IMAP4.error, OSError) as e:
+            logger.logger.error(f"IMAP session lost: {e}. Reconnecting in {reconnect_delay} seconds.")
+            time.sleep(reconnect_delay)
 
 # Setup the databse if it does not exist
 db.setup_database()
 
+# Renew message claims in the background and forget request times outside the rate limit window
+db.start_maintenance(smtp.mail_rate_limit)
+
+# Profile the next fetch cycles on SIGUSR1 (or GET /debug/profile on the metrics port when admin routes are on)
+profiler.install_signal_handler()
+
+# Serve the Prometheus metrics endpoint
+metrics.start_server()
+
+# Load the timezone data once before the first request needs it
+openWeatherHelper.warm_timezone_finder()
+
+# Send the subscription reports when they are due
+subscriptions.start_scheduler(smtp.send_scheduled_reports, smtp.weather_api_key)
+
+# Fetch the forecasts of the most requested grid cells again before they expire
+prefetch.start_refresher(smtp.weather_api_key)
+
 # Set up a thread to run the function
-thread = threading.Thread(target=run_interval, args=(interval,))
+thread = threading.Thread(target=watch_mailbox)
 thread.start()
\ No newline at end of file
@@ -0,0 +1,73 @@
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from modules import db
+
+# Function to look up a sender the way the old db module did, a new connection and a full table scan per call
+def legacy_get_last_request_time(path, email):
+    conn = sqlite3.connect(path)
+    with conn:
+        cur = conn.cursor()
+        cur.execute("SELECT last_request_time FROM requests WHERE email = ?", (email,))
+        result = cur.fetchone()
+    return result[0] if result else None
+
+# Function to store a request time the way the old db module did, which appended a row every time
+def legacy_update_last_request_time(path, email, time_stamp):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO requests (email, last_request_time) VALUES (?, ?)", (email, time_stamp))
+        conn.commit()
+
+# Function to build a requests table the way the old schema grew, one appended row per request
+def build_legacy_table(path, rows, senders):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE requests (email TEXT NOT NULL, last_request_time REAL NOT NULL)")
+    start = time.time() - rows
+    conn.executemany("INSERT INTO requests (email, last_request_time) VALUES (?, ?)",
+                     ((f"N0CALL{index % senders}@winlink.org", start + index) for index in range(rows)))
+    conn.commit()
+    conn.close()
+
+def time_calls(func, emails):
+    times = []
+    for email in emails:
+        start = time.perf_counter()
+        func(email)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+def report(name, times):
+    print(f"{name:<24} median {statistics.median(times):8.3f} ms   p99 {sorted(times)[int(len(times) * 0.99)]:8.3f} ms   calls {len(times)}")
+
+def main(rows=500000, senders=2000, lookups=500):
+    rnd = random.Random(0)
+    emails = [f"N0CALL{rnd.randrange(senders)}@winlink.org" for _ in range(lookups)]
+    new_senders = [f"N1NEW{index}@winlink.org" for index in range(lookups)]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'request_times.db')
+        build_legacy_table(path, rows, senders)
+        print(f"legacy table: {rows} rows for {senders} senders, {os.path.getsize(path) / 1e6:.1f} MB")
+
+        report("before lookup", time_calls(lambda email: legacy_get_last_request_time(path, email), emails))
+        report("before lookup (new)", time_calls(lambda email: legacy_get_last_request_time(path, email), new_senders))
+        report("before update", time_calls(lambda email: legacy_update_last_request_time(path, email, time.time()), emails))
+
+        db.db_path = path
+        start = time.perf_counter()
+        db.setup_database()
+        count = db.get_connection().execute("SELECT COUNT(*) FROM requests").fetchone()[0]
+        print(f"migration                {(time.perf_counter() - start) * 1000:8.1f} ms, {count} rows left, {os.path.getsize(path) / 1e6:.1f} MB")
+
+        report("after lookup (cold)", time_calls(db.get_last_request_time, emails))
+        report("after lookup (new)", time_calls(db.get_last_request_time, new_senders))
+        report("after lookup (repeat)", time_calls(db.get_last_request_time, emails))
+        report("after update", time_calls(lambda email: db.update_last_request_time(email, time.time()), emails))
+        report("after rate limit check", time_calls(lambda email: db.record_request_time(email, time.time(), 30), emails))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
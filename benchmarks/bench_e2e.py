@@ -0,0 +1,86 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks import fakes
+from benchmarks.payloads import locations
+
+# Bodies cycle through every way a location can be written, the city names need the (fake) Open AI
+bodies = [f"{lat}, {long}" for lat, long in locations] + ['EM10dh', 'IO91wm', 'QF56od'] + [place.title() for place in fakes.places]
+subjects = ['weather:current', 'weather:daily', 'weather:hourly', 'weather:daily:compact']
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else float('nan')
+
+# Function to fill the fake inbox, every sender is new so none of the requests are rate limited
+def fill_mailbox(mailbox, backlog):
+    for index in range(backlog):
+        body = bodies[index % len(bodies)]
+        if index % 5 == 4:
+            body = f"Town {index}, somewhere"  # Unknown to the geocode cache, always a miss
+        mailbox.add(f"N{index}BENCH@winlink.org", subjects[index % len(subjects)], body)
+
+# Function to run one backlog against fresh fakes in this process and print its results
+def run_scenario(args, backlog):
+    imap = fakes.serve(fakes.FakeImapServer())
+    smtp_sink = fakes.serve(fakes.FakeSmtpServer(latency=args.smtp_latency))
+    api = fakes.serve(fakes.FakeApiServer(latency={'openai': args.openai_latency, 'openweather': args.weather_latency},
+                                          error_rate={'openai': args.error_rate, 'openweather': args.error_rate}))
+
+    # The app reads its configuration at import time, so it is only imported once the fakes have their ports
+    os.environ.update({
+        'IMAP_HOST': '127.0.0.1', 'IMAP_PORT': str(imap.server_address[1]), 'IMAP_SSL': 'false',
+        'SMTP_HOST': '127.0.0.1', 'SMTP_PORT': str(smtp_sink.server_address[1]), 'SMTP_STARTTLS': 'false',
+        'OAI_BASE_URL': f"{api.url}/v1", 'WEATHER_BASE_URL': api.url,
+        'SMTP_USERNAME': 'bench@localhost', 'SMTP_PASSWORD': 'bench', 'ALLOWED_DOMAINS': '*',
+        'OAI_API_KEY': 'bench', 'WEATHER_API_KEY': 'bench',
+    })
+    for name, value in (('LOG_LEVEL', 'WARNING'), ('METRICS_PORT', '0'), ('OAI_RATE_LIMIT', '0'), ('WEATHER_RATE_LIMIT', '0'),
+                        ('UPSTREAM_BACKOFF_BASE', '0.05')):
+        os.environ.setdefault(name, value)
+    from modules import db, smtp, openWeatherHelper
+
+    workdir = tempfile.TemporaryDirectory(prefix='winlink-bench-')  # Removed when the process exits
+    db.db_path = os.path.join(workdir.name, 'request_times.db')
+    db.setup_database()
+    openWeatherHelper.warm_timezone_finder()
+    fill_mailbox(imap.mailbox, backlog)
+
+    start = time.perf_counter()
+    found = smtp.fetch_emails()
+    elapsed = time.perf_counter() - start
+
+    latencies = [delivery['time'] - start for delivery in smtp_sink.delivered]
+    processed = len(imap.mailbox.folder('Processed'))
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+    print(f"backlog {backlog:>5}   found {found!s:>5}   sent {len(latencies):>5}   moved {processed:>5}   "
+          f"{len(latencies) / elapsed:8.1f} msg/s   p50 {percentile(latencies, 0.5) * 1000:8.1f} ms   "
+          f"p99 {percentile(latencies, 0.99) * 1000:8.1f} ms   peak RSS {peak_rss:6.1f} MB   "
+          f"upstream {api.requests}", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive smtp.fetch_emails through a backlog against local fakes")
+    parser.add_argument('backlogs', nargs='*', type=int, default=[10, 100, 1000])
+    parser.add_argument('--openai-latency', type=float, default=0.2)
+    parser.add_argument('--weather-latency', type=float, default=0.05)
+    parser.add_argument('--smtp-latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--in-process', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.in_process:
+        run_scenario(args, args.backlogs[0])
+        return
+
+    # Each backlog runs in its own process so caches start cold and peak RSS is per scenario
+    options = ['--openai-latency', str(args.openai_latency), '--weather-latency', str(args.weather_latency),
+               '--smtp-latency', str(args.smtp_latency), '--error-rate', str(args.error_rate)]
+    for backlog in args.backlogs:
+        subprocess.run([sys.executable, '-m', 'benchmarks.bench_e2e', str(backlog), '--in-process'] + options, check=True)
+
+if __name__ == '__main__':
+    main()
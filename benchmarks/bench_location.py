@@ -0,0 +1,48 @@
+import time
+import statistics
+from modules import locationParser
+
+# Bodies and the coordinates the local parser must give them, None means the body has to go to OpenAI
+parser_cases = [
+    ("29.76, -95.37", (29.76, -95.37)),
+    ("29.76N 95.37W", (29.76, -95.37)),
+    ("95.37W 29.76N", (29.76, -95.37)),
+    ("(29.76, -95.37)", (29.76, -95.37)),
+    ("lat 29.76 lon -95.37 metric", (29.76, -95.37)),
+    ("provide the weather for 51.510047731805415, -0.04960678749831505 using the metric system", (51.510047731805415, -0.04960678749831505)),
+    ("40°26'46\"N 79°58'56\"W", (40.446111, -79.982222)),
+    ("EM10dh", (30.3125, -97.7083)),
+    ("Houston, Texas", None),
+    ("90048", None),
+    # Free text with numbers in it is not a coordinate pair
+    ("I-10 exit 24.5", None),
+    ("Apt 4, 12.5 Main St", None),
+    ("Route 66 km 12.5", None),
+    ("Mile marker 12.5 on I-95", None),
+]
+
+# Function to check every case, returns the number of mismatches
+def check_parser():
+    failures = 0
+    for text, expected in parser_cases:
+        location = locationParser.parse_location(text, record=False)
+        got = (location['lat'], location['long']) if location is not None else None
+        if got != expected:
+            print(f"MISMATCH {text!r}: expected {expected}, got {got}")
+            failures += 1
+    print(f"parser check: {len(parser_cases) - failures} of {len(parser_cases)} as expected")
+    return failures
+
+def main(runs=2000):
+    failures = check_parser()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for text, _ in parser_cases:
+            locationParser.parse_location(text, record=False)
+        times.append((time.perf_counter() - start) * 1e6 / len(parser_cases))
+    print(f"{'parse_location':<28} median {statistics.median(times):8.2f} us per body   runs {runs}")
+    raise SystemExit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import statistics
+from modules import openWeatherHelper
+from benchmarks.payloads import onecall_payload, locations
+
+golden_dir = os.path.join(os.path.dirname(__file__), 'golden')
+
+renderers = {
+    'daily': openWeatherHelper.generate_daily_forecast,
+    'current': openWeatherHelper.generate_current_forecast,
+    'hourly': openWeatherHelper.generate_hourly_forecast,
+}
+
+# Sample cases kept as golden files: every report type and unit, with and without alerts
+golden_cases = [(report_type, unit, seed, alerts) for report_type in renderers for unit in ('imperial', 'metric') for seed, alerts in ((0, 2), (1, 0))]
+
+def golden_path(report_type, unit, seed):
+    return os.path.join(golden_dir, f"{report_type}_{unit}_{seed}.txt")
+
+def render_case(report_type, unit, seed, alerts):
+    lat, long = locations[seed]
+    return renderers[report_type](onecall_payload(seed, alerts=alerts), lat=lat, long=long, unit=unit)
+
+# Function to write the golden files from the current renderers
+def update_golden():
+    os.makedirs(golden_dir, exist_ok=True)
+    for report_type, unit, seed, alerts in golden_cases:
+        with open(golden_path(report_type, unit, seed), 'wb') as golden:
+            golden.write(render_case(report_type, unit, seed, alerts).encode('utf-8'))
+    print(f"Wrote {len(golden_cases)} golden files to {golden_dir}")
+
+# Function to check the renderers still produce byte identical output, returns the number of mismatches
+def check_golden():
+    failures = 0
+    for report_type, unit, seed, alerts in golden_cases:
+        with open(golden_path(report_type, unit, seed), 'rb') as golden:
+            expected = golden.read()
+        if render_case(report_type, unit, seed, alerts).encode('utf-8') != expected:
+            print(f"MISMATCH {golden_path(report_type, unit, seed)}")
+            failures += 1
+    print(f"golden check: {len(golden_cases) - failures} of {len(golden_cases)} identical")
+    return failures
+
+def main(runs=200):
+    if '--update' in sys.argv:
+        update_golden()
+        return
+    failures = check_golden()
+
+    openWeatherHelper.warm_timezone_finder()
+    payload = onecall_payload()
+    lat, long = locations[0]
+    for report_type, render in renderers.items():
+        for unit in ('imperial', 'metric'):
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                render(payload, lat=lat, long=long, unit=unit)
+                times.append((time.perf_counter() - start) * 1000)
+            print(f"{report_type:<8} {unit:<9} median {statistics.median(times):7.3f} ms   min {min(times):7.3f} ms   runs {runs}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import zlib
+from modules import openWeatherHelper
+from benchmarks.payloads import onecall_payload, locations
+
+# Verbose renderers as sent today
+verbose_renderers = {
+    'daily': openWeatherHelper.generate_daily_forecast,
+    'current': openWeatherHelper.generate_current_forecast,
+    'hourly': openWeatherHelper.generate_hourly_forecast,
+}
+
+# Function to get the raw and compressed size of a report (Winlink compresses messages before sending them)
+def sizes(report):
+    encoded = report.encode('utf-8')
+    return len(encoded), len(zlib.compress(encoded, 9))
+
+def main(byte_budgets=(None, 1000, 500)):
+    print(f"{'report':<8} {'unit':<9} {'verbose':>9} {'(zip)':>7}   " + '   '.join(f"{'compact' if budget is None else f'<= {budget}':>9} {'(zip)':>7}" for budget in byte_budgets))
+    totals = {}
+    for report_type, render in verbose_renderers.items():
+        for unit in ('imperial', 'metric'):
+            verbose = [sizes(render(onecall_payload(seed), lat=lat, long=long, unit=unit)) for seed, (lat, long) in enumerate(locations)]
+            row = [verbose]
+            for budget in byte_budgets:
+                row.append([sizes(openWeatherHelper.generate_compact_forecast(onecall_payload(seed), report_type, lat, long, unit=unit, byte_budget=budget))
+                            for seed, (lat, long) in enumerate(locations)])
+            averages = [(sum(raw for raw, _ in column) / len(column), sum(packed for _, packed in column) / len(column)) for column in row]
+            for index, average in enumerate(averages):
+                totals.setdefault(index, []).append(average)
+            print(f"{report_type:<8} {unit:<9} " + '   '.join(f"{raw:9.0f} {packed:7.0f}" for raw, packed in averages))
+
+    verbose_raw = sum(raw for raw, _ in totals[0])
+    for index, budget in enumerate(byte_budgets, 1):
+        compact_raw = sum(raw for raw, _ in totals[index])
+        print(f"{'compact' if budget is None else f'budget {budget}'}: {compact_raw / verbose_raw:.0%} of the verbose bytes")
+
+if __name__ == '__main__':
+    main()
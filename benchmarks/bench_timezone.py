@@ -0,0 +1,65 @@
+import time
+import statistics
+from timezonefinder import TimezoneFinder
+import pytz
+from modules import openWeatherHelper
+from benchmarks.payloads import onecall_payload, locations
+
+# Timezone lookup as it was before the shared finder, one TimezoneFinder per call
+def legacy_get_timezone(lat, long):
+    tf = TimezoneFinder()
+    return pytz.timezone(tf.timezone_at(lat=float(lat), lng=float(long)))
+
+# Function to count the timestamps a report formats, the legacy renderers resolved the zone once for each
+def legacy_timestamps(payload, report_type):
+    entries = 1 if report_type == 'current' else len(payload[report_type])
+    return entries + 2 * len(payload.get('alerts', []))
+
+# Function to render with the legacy lookup, repeated for every timestamp the legacy renderer formatted
+def legacy_render(render, payload, report_type, lat, long):
+    render(payload, lat=lat, long=long)
+    for _ in range(legacy_timestamps(payload, report_type) - 1):
+        legacy_get_timezone(lat, long)
+
+# Function to time a callable and return the individual run times in milliseconds
+def time_runs(func, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+def report(name, times):
+    print(f"{name:<28} median {statistics.median(times):8.2f} ms   min {min(times):8.2f} ms   runs {len(times)}")
+
+def main(runs=5):
+    payload = onecall_payload()
+    renderers = [
+        ('daily', openWeatherHelper.generate_daily_forecast),
+        ('current', openWeatherHelper.generate_current_forecast),
+        ('hourly', openWeatherHelper.generate_hourly_forecast),
+    ]
+
+    lat, long = locations[0]
+
+    start = time.perf_counter()
+    openWeatherHelper.warm_timezone_finder()
+    print(f"{'warm timezone finder':<28} {(time.perf_counter() - start) * 1000:8.2f} ms (once per process)")
+
+    # Before: every timestamp in a report resolved its zone with a new TimezoneFinder. The renderers now resolve the
+    # zone once per report, so the legacy lookup is timed once per formatted timestamp on top of the render
+    get_timezone = openWeatherHelper.get_timezone
+    openWeatherHelper.get_timezone = legacy_get_timezone
+    try:
+        for name, render in renderers:
+            report(f"before {name}", time_runs(lambda: legacy_render(render, payload, name, lat, long), runs))
+    finally:
+        openWeatherHelper.get_timezone = get_timezone
+
+    # After: shared finder warmed up front, zone resolved once per report
+    for name, render in renderers:
+        report(f"after {name}", time_runs(lambda: render(payload, lat=lat, long=long), runs * 20))
+
+if __name__ == '__main__':
+    main()
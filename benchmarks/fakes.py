@@ -0,0 +1,338 @@
+import json
+import random
+import re
+import select
+import socketserver
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from benchmarks.payloads import onecall_payload
+
+# In-process stand-ins for the IMAP server, the SMTP server and the Open AI / Open Weather APIs, so the whole
+# fetch loop can run offline. They speak just enough of each protocol for the app's own client code.
+
+# Places the fake Open AI knows by name, anything else gets repeatable made up coordinates
+places = {
+    'houston, tx': (29.76, -95.37),
+    'london, uk': (51.51, -0.13),
+    'tokyo, japan': (35.68, 139.69),
+    'sydney, australia': (-33.87, 151.21),
+    'fairbanks, ak': (64.84, -147.72),
+    'denver, co': (39.74, -104.99),
+    'anchorage, ak': (61.22, -149.9),
+    'honolulu, hi': (21.31, -157.86),
+    'são paulo, brazil': (-23.55, -46.63),
+}
+
+# Function to start a socket server on a free local port in a background thread
+def serve(server):
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=type(server).__name__, daemon=True).start()
+    return server
+
+# Messages held by the fake IMAP server, each one in a folder
+class Mailbox:
+    def __init__(self):
+        self.messages = []
+        self.next_uid = 1
+        self.lock = threading.Lock()
+
+    def add(self, sender, subject, body):
+        with self.lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            headers = f"From: {sender}\r\nSubject: {subject}\r\nMessage-ID: <{uid}.bench@localhost>\r\n\r\n"
+            self.messages.append({'uid': uid, 'folder': 'INBOX', 'flags': set(), 'headers': headers.encode('ascii'),
+                                  'body': body.encode('utf-8')})
+            return uid
+
+    def folder(self, name):
+        with self.lock:
+            return [message for message in self.messages if message['folder'] == name.upper()]
+
+# Function to expand an IMAP UID set, eg "1:3,7" or "5:*"
+def parse_uid_set(text, highest):
+    uids = set()
+    for part in text.split(','):
+        start, _, end = part.partition(':')
+        start = highest if start == '*' else int(start)
+        end = start if not end else highest if end == '*' else int(end)
+        uids.update(range(min(start, end), max(start, end) + 1))
+    return uids
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    # Like Gmail and Dovecot, MOVE is only listed once logged in
+    capabilities = 'IMAP4rev1 IDLE UIDPLUS'
+    authenticated_capabilities = 'IMAP4rev1 IDLE MOVE UIDPLUS'
+
+    def send(self, text):
+        self.wfile.write(text if isinstance(text, bytes) else text.encode('utf-8') + b'\r\n')
+
+    def inbox(self):
+        return self.server.mailbox.folder('INBOX')
+
+    # Like a real server, report mail that arrived since the last command in the reply to the next one
+    def announce(self):
+        count = len(self.inbox())
+        if count > self.known:
+            self.send(f"* {count} EXISTS")
+        self.known = count
+
+    def handle(self):
+        self.known = 0
+        self.logged_in = False
+        self.send(f"* OK [CAPABILITY {self.capabilities}] fake IMAP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.decode('utf-8').rstrip('\r\n').partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            if command == 'UID':
+                command, _, args = args.partition(' ')
+                command = 'UID_' + command.upper()
+            handler = getattr(self, 'cmd_' + command.lower(), None)
+            if handler is None:
+                self.send(f"{tag} BAD unknown command {command}")
+                continue
+            if command not in ('SELECT', 'IDLE'):
+                self.announce()
+            if handler(tag, args) is False:
+                return
+
+    def cmd_capability(self, tag, args):
+        self.send(f"* CAPABILITY {self.authenticated_capabilities if self.logged_in else self.capabilities}")
+        self.send(f"{tag} OK CAPABILITY completed")
+
+    def cmd_login(self, tag, args):
+        self.logged_in = True
+        self.send(f"{tag} OK LOGIN completed")
+
+    def cmd_select(self, tag, args):
+        self.known = len(self.inbox())
+        self.send(f"* {self.known} EXISTS")
+        self.send("* 0 RECENT")
+        self.send(f"{tag} OK [READ-WRITE] SELECT completed")
+
+    def cmd_noop(self, tag, args):
+        self.send(f"{tag} OK NOOP completed")
+
+    def cmd_close(self, tag, args):
+        self.send(f"{tag} OK CLOSE completed")
+
+    def cmd_logout(self, tag, args):
+        self.send("* BYE logging out")
+        self.send(f"{tag} OK LOGOUT completed")
+        return False
+
+    def cmd_uid_search(self, tag, args):
+        term = re.search(r'SUBJECT "([^"]*)"', args, re.IGNORECASE)
+        unseen = 'UNSEEN' in args.upper()
+        uids = [str(message['uid']) for message in self.inbox()
+                if (term is None or term.group(1).lower() in message['headers'].decode('ascii').lower())
+                and not (unseen and '\\Seen' in message['flags'])]
+        self.send(f"* SEARCH {' '.join(uids)}".rstrip())
+        self.send(f"{tag} OK SEARCH completed")
+
+    def cmd_uid_fetch(self, tag, args):
+        message_set, _, items = args.partition(' ')
+        inbox = self.inbox()
+        wanted = parse_uid_set(message_set, max((message['uid'] for message in inbox), default=0))
+        section = re.search(r'BODY\.PEEK\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', items, re.IGNORECASE)
+        for sequence, message in enumerate(inbox, 1):
+            if message['uid'] not in wanted:
+                continue
+            response = f"* {sequence} FETCH (UID {message['uid']}".encode('ascii')
+            if section is not None:
+                name, start, count = section.groups()
+                data = message['headers'] if name.upper().startswith('HEADER') else message['body']
+                key = f"BODY[{name}]"
+                if start is not None:
+                    data = data[int(start):int(start) + int(count)]
+                    key += f"<{start}>"
+                response += f" {key} {{{len(data)}}}\r\n".encode('ascii') + data
+            if 'BODYSTRUCTURE' in items.upper():
+                # Bodies that are not plain ASCII are sent unencoded, as 8bit
+                encoding = '7bit' if message['body'].isascii() else '8bit'
+                response += f' BODYSTRUCTURE ("text" "plain" ("charset" "utf-8") NIL NIL "{encoding}" {len(message["body"])} 1)'.encode('ascii')
+            self.send(response + b')\r\n')
+        self.send(f"{tag} OK FETCH completed")
+
+    def cmd_uid_move(self, tag, args):
+        message_set, _, folder = args.partition(' ')
+        inbox = self.inbox()
+        wanted = parse_uid_set(message_set, max((message['uid'] for message in inbox), default=0))
+        # Expunge responses count down so the sequence numbers stay valid
+        for sequence, message in reversed(list(enumerate(inbox, 1))):
+            if message['uid'] in wanted:
+                message['folder'] = folder.strip('"').upper()
+                self.send(f"* {sequence} EXPUNGE")
+        self.send(f"{tag} OK MOVE completed")
+
+    def cmd_uid_copy(self, tag, args):
+        self.send(f"{tag} NO use MOVE")
+
+    def cmd_uid_store(self, tag, args):
+        self.send(f"{tag} NO use MOVE")
+
+    def cmd_idle(self, tag, args):
+        self.send("+ idling")
+        while True:
+            readable, _, _ = select.select([self.connection], [], [], 0.05)
+            if readable:
+                self.rfile.readline()  # DONE
+                self.send(f"{tag} OK IDLE terminated")
+                return
+            self.announce()
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, mailbox=None):
+        self.mailbox = mailbox or Mailbox()
+        super().__init__(('127.0.0.1', 0), FakeImapHandler)
+
+# Accepts every message and keeps when and to whom it was delivered
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+    def send(self, text):
+        self.wfile.write(text.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.send("220 fake ESMTP ready")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'EHLO':
+                self.send("250-localhost")
+                self.send("250-AUTH PLAIN LOGIN")
+                self.send("250 8BITMIME")
+            elif verb == 'AUTH':
+                self.send("235 authenticated")
+            elif verb == 'RCPT':
+                recipients.append(re.sub(r'^RCPT TO:\s*<?([^>]*)>?.*$', r'\1', command, flags=re.IGNORECASE))
+                self.send("250 OK")
+            elif verb == 'DATA':
+                self.send("354 end with .")
+                data = []
+                for data_line in iter(self.rfile.readline, b''):
+                    if data_line == b'.\r\n':
+                        break
+                    data.append(data_line)
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                self.server.record(recipients, b''.join(data))
+                recipients = []
+                self.send("250 OK queued")
+            elif verb == 'QUIT':
+                self.send("221 bye")
+                return
+            else:
+                self.send("250 OK")
+
+class FakeSmtpServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.delivered = []
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), FakeSmtpHandler)
+
+    def record(self, recipients, data):
+        with self.lock:
+            self.delivered.append({'time': time.perf_counter(), 'recipients': recipients, 'data': data})
+
+# Function to make up repeatable coordinates for a place the fake does not know
+def made_up_location(text):
+    seed = zlib.crc32(text.lower().encode('utf-8'))
+    return round((seed % 12000) / 100 - 60, 2), round((seed // 12000 % 36000) / 100 - 180, 2)
+
+# Function to answer one location the way the real model does
+def fake_location(text):
+    lat, long = places.get(text.strip().lower()) or made_up_location(text)
+    units = 'metric' if re.search(r'metric|celsius|celcius', text, re.IGNORECASE) else 'imperial'
+    return {'lat': lat, 'long': long, 'units': units}
+
+# Serves Open AI chat completions and Open Weather OneCall with configurable latency and error rates
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # Sleep for the provider's latency and maybe fail, returns True if an error was sent
+    def simulate(self, provider):
+        self.server.count(provider)
+        latency = self.server.latency.get(provider, 0)
+        if latency:
+            time.sleep(latency)
+        if self.server.random() < self.server.error_rate.get(provider, 0):
+            if self.server.random() < 0.5:
+                self.reply(429, {'error': 'rate limited'}, {'Retry-After': '0'})
+            else:
+                self.reply(500, {'error': 'server error'})
+            return True
+        return False
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.endswith('/chat/completions'):
+            return self.reply(404, {'error': 'not found'})
+        if self.simulate('openai'):
+            return
+        text = request['messages'][-1]['content']
+        if '\ufffd' in text:
+            self.server.count('garbled')  # A body decoded with the wrong charset, shows up in the bench output
+        if 'response_format' in request:
+            content = {index: fake_location(location) for index, location in json.loads(text).items()}
+        else:
+            content = fake_location(text)
+        self.reply(200, {'choices': [{'message': {'role': 'assistant', 'content': json.dumps(content)}}]})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if not url.path.endswith('/onecall'):
+            return self.reply(404, {'error': 'not found'})
+        if self.simulate('openweather'):
+            return
+        query = parse_qs(url.query)
+        seed = zlib.crc32(f"{query['lat'][0]},{query['lon'][0]}".encode('ascii'))
+        self.reply(200, onecall_payload(seed, alerts=seed % 3))
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeApiServer(ThreadingHTTPServer):
+    def __init__(self, latency=None, error_rate=None, seed=0):
+        self.latency = latency or {}
+        self.error_rate = error_rate or {}
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.rnd = random.Random(seed)
+        super().__init__(('127.0.0.1', 0), FakeApiHandler)
+
+    def random(self):
+        with self.lock:
+            return self.rnd.random()
+
+    def count(self, provider):
+        with self.lock:
+            self.requests[provider] = self.requests.get(provider, 0) + 1
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
@@ -0,0 +1,75 @@
+import random
+
+# Start of the sample payloads (2024-03-01 12:00 UTC) so output is repeatable
+base_time = 1709294400
+
+descriptions = ['clear sky', 'few clouds', 'scattered clouds', 'broken clouds', 'light rain', 'moderate rain', 'overcast clouds']
+
+# Sample locations used by the benchmarks (lat, long)
+locations = [
+    (29.76, -95.37),   # Houston
+    (51.51, -0.05),    # London
+    (35.68, 139.69),   # Tokyo
+    (-33.87, 151.21),  # Sydney
+    (64.84, -147.72),  # Fairbanks
+]
+
+# Function to build a OneCall style payload with current, 48 hourly and 8 daily entries
+def onecall_payload(seed=0, alerts=2):
+    rnd = random.Random(seed)
+
+    def weather():
+        return [{"description": rnd.choice(descriptions)}]
+
+    current = {
+        "dt": base_time,
+        "temp": round(rnd.uniform(20, 95), 2),
+        "feels_like": round(rnd.uniform(20, 95), 2),
+        "humidity": rnd.randint(10, 100),
+        "wind_speed": round(rnd.uniform(0, 30), 2),
+        "weather": weather(),
+        "rain": {"1h": round(rnd.uniform(0, 5), 2)},
+    }
+
+    hourly = []
+    for i in range(48):
+        hour = {
+            "dt": base_time + i * 3600,
+            "temp": round(rnd.uniform(20, 95), 2),
+            "feels_like": round(rnd.uniform(20, 95), 2),
+            "humidity": rnd.randint(10, 100),
+            "wind_speed": round(rnd.uniform(0, 30), 2),
+            "weather": weather(),
+        }
+        if i % 3 == 0:
+            hour["rain"] = {"1h": round(rnd.uniform(0, 5), 2)}
+        hourly.append(hour)
+
+    daily = []
+    for i in range(8):
+        day = {
+            "dt": base_time + i * 86400,
+            "summary": f"Expect a day of {rnd.choice(descriptions)} with a chance of {rnd.choice(descriptions)}",
+            "temp": {"day": round(rnd.uniform(20, 95), 2), "min": round(rnd.uniform(10, 60), 2), "max": round(rnd.uniform(60, 105), 2)},
+            "humidity": rnd.randint(10, 100),
+            "wind_speed": round(rnd.uniform(0, 30), 2),
+            "weather": weather(),
+        }
+        if i % 2 == 0:
+            day["rain"] = round(rnd.uniform(0, 20), 2)
+        daily.append(day)
+
+    payload = {"current": current, "hourly": hourly, "daily": daily}
+    if alerts:
+        payload["alerts"] = [
+            {
+                "event": "Wind Advisory" if i % 2 == 0 else "Flood Watch",
+                "start": base_time + i * 7200,
+                "end": base_time + i * 7200 + 43200,
+                "description": ("* WHAT...Southwest winds 20 to 30 mph with gusts up to 50 mph expected. "
+                                "* WHERE...Portions of the area. * IMPACTS...Gusty winds could blow around "
+                                "unsecured objects. Tree limbs could be blown down and a few power outages may result. ") * 3,
+            }
+            for i in range(alerts)
+        ]
+    return payload
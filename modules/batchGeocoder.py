@@ -0,0 +1,107 @@
+import threading
+import time
+from .logger import logger
+from modules import upstream
+
+# Collects the location strings waiting to be geocoded and resolves them together. A batch is sent when it is
+# full, when the oldest string has waited batch_wait seconds or when flushed. Strings the batch could not resolve are retried
+# one at a time. Strings can also be submitted ahead of time without waiting for them. Each string keeps the upstream
+# priority of the most urgent request waiting on it, and a batch is sent with the most urgent priority in it.
+class BatchGeocoder:
+    def __init__(self, resolve_batch, resolve_one, batch_size=10, batch_wait=1.0, on_resolved=None, on_sent=None):
+        self.resolve_batch = resolve_batch
+        self.resolve_one = resolve_one
+        self.on_resolved = on_resolved
+        self.on_sent = on_sent
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.pending = []
+        self.flushing = False
+        self.entries = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="batch-geocoder", daemon=True)
+                self.thread.start()
+
+    # Queue a location string, the same string already waiting or in flight is shared
+    def submit(self, key, location_content):
+        self.start()
+        with self.condition:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = {'text': location_content, 'event': threading.Event(), 'result': None, 'error': None,
+                         'queued': time.monotonic(), 'priority': upstream.current_priority()}
+                self.entries[key] = entry
+                self.pending.append(key)
+                self.condition.notify_all()
+            else:
+                entry['priority'] = min(entry['priority'], upstream.current_priority())
+            return entry
+
+    # Send everything queued now instead of waiting for the batch to fill, eg once a fetch cycle submitted all it has
+    def flush(self):
+        with self.condition:
+            if self.pending:
+                self.flushing = True
+                self.condition.notify_all()
+
+    # Resolve a location string, waiting for the batch it ends up in, re-raises the error if it could not be resolved
+    def resolve(self, key, location_content):
+        entry = self.submit(key, location_content)
+        self.flush()  # The caller is waiting, whatever else is queued already goes with it
+        entry['event'].wait()
+        if entry['result'] is None and entry['error'] is not None:
+            raise entry['error']
+        return entry['result']
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                # Give other strings from the same cycle a chance to join the batch
+                deadline = self.entries[self.pending[0]]['queued'] + self.batch_wait
+                while len(self.pending) < self.batch_size and not self.flushing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                keys, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+                self.flushing = self.flushing and bool(self.pending)
+                batch = [(key, self.entries[key]) for key in keys]
+
+            try:
+                with upstream.priority(min(entry['priority'] for _, entry in batch)):
+                    self.process(batch)
+            except Exception as e:
+                logger.error(f"Batch geocoding failed: {str(e)}")
+            finally:
+                with self.condition:
+                    for key, entry in batch:
+                        del self.entries[key]
+                        entry['event'].set()
+
+    def process(self, batch):
+        if self.on_sent is not None:
+            self.on_sent(len(batch))
+        results = {}
+        if len(batch) > 1:
+            try:
+                results = self.resolve_batch([entry['text'] for _, entry in batch])
+            except Exception as e:
+                logger.error(f"Batch geocoding request failed, retrying one at a time: {str(e)}")
+            logger.info(f"Batch geocoded {len(results)} of {len(batch)} locations")
+
+        for index, (_, entry) in enumerate(batch):
+            entry['result'] = results.get(index)
+            if entry['result'] is None:
+                try:
+                    entry['result'] = self.resolve_one(entry['text'])
+                except Exception as e:
+                    logger.error(f"Geocoding failed for {entry['text']}: {str(e)}")
+                    entry['error'] = e
+            if entry['result'] is not None and self.on_resolved is not None:
+                self.on_resolved(entry['text'], entry['result'])
@@ -0,0 +1,95 @@
+import os
+import smtplib
+import threading
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from .logger import logger
+
+# HTTP Configuration
+http_timeout = float(os.getenv('HTTP_TIMEOUT', '30'))
+http_pool_size = int(os.getenv('HTTP_POOL_SIZE', '10'))
+
+_session = None
+_session_lock = threading.Lock()
+
+# Function to get the shared keep-alive HTTP session used for Open AI and Open Weather
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=http_pool_size, pool_maxsize=http_pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+# Function to send a GET request over the shared session with the default timeout
+def http_get(url, **kwargs):
+    kwargs.setdefault('timeout', http_timeout)
+    return get_session().get(url, **kwargs)
+
+# Function to send a POST request over the shared session with the default timeout
+def http_post(url, **kwargs):
+    kwargs.setdefault('timeout', http_timeout)
+    return get_session().post(url, **kwargs)
+
+# Reusable SMTP connection, kept open for a whole batch and reconnected if the server drops it
+class SmtpConnection:
+    def __init__(self, host, port, username, password, starttls=True):
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.server = None
+        self.batch_depth = 0
+        self.lock = threading.RLock()
+
+    def connect(self):
+        logger.debug(f"connecting to SMTP server {self.host}:{self.port}")
+        server = smtplib.SMTP(self.host, self.port, timeout=http_timeout)
+        if self.starttls:
+            server.starttls()
+        server.login(self.username, self.password)
+        self.server = server
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        with self.lock:
+            try:
+                if self.server is None:
+                    self.connect()
+                try:
+                    self.server.sendmail(from_addr, to_addrs, msg)
+                except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                    # The server closed an idle connection, reconnect once and retry
+                    logger.info(f"SMTP connection lost ({str(e)}), reconnecting")
+                    self.server = None
+                    self.connect()
+                    self.server.sendmail(from_addr, to_addrs, msg)
+            finally:
+                if self.batch_depth == 0:
+                    self.close()
+
+    # Keep the connection open until the outermost batch finishes
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.close()
@@ -1,61 +1,399 @@
 import sqlite3
+import json
+import re
+import socket
+import threading
+import time
 from .logger import logger
+from modules import metrics
 import os
 
+# Database Configuration
+db_path = os.getenv('DB_PATH', 'db/request_times.db')  # Point every instance at the same file to share claims and rate limits
+geocode_cache_ttl = int(os.getenv('GEOCODE_CACHE_TTL', str(30 * 24 * 3600)))
+geocode_cache_size = int(os.getenv('GEOCODE_CACHE_SIZE', '5000'))
+db_flush_interval = int(os.getenv('DB_FLUSH_INTERVAL', '10'))
+db_busy_timeout = float(os.getenv('DB_BUSY_TIMEOUT', '30'))
+instance_id = os.getenv('INSTANCE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+claim_lease_ttl = int(os.getenv('CLAIM_LEASE_TTL', '120'))  # Seconds before a claim that is not renewed can be taken over
+claim_retention = int(os.getenv('CLAIM_RETENTION', '86400'))  # Seconds a finished claim is kept so other instances skip it
+journal_retention = int(os.getenv('JOURNAL_RETENTION', str(7 * 24 * 3600)))
+forecast_store_max_age = int(os.getenv('FORECAST_STALE_MAX', '21600'))
+
+# Stages a request goes through, in order. A reply in "sending" may have gone out and is never sent again
+journal_stages = ('received', 'geocoded', 'fetched', 'rendered', 'sending', 'sent', 'moved')
+
+# One long lived connection shared by every thread, access is serialized with the lock
+_conn = None
+_db_lock = threading.RLock()
+
+# Messages this instance has claimed and not finished yet, their leases are renewed in the background
+_held_claims = set()
+
 #Function to connect to the db
 def create_connection(db_file):
     """ Create a database connection to a SQLite database """
     logger.debug("connecting to database")
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, timeout=db_busy_timeout, check_same_thread=False)
         return conn
     except Exception as e:
         logger.error(f"Error connecting to database: {str(e)}")
     return conn
 
+#Function to get the shared connection, opened in WAL mode the first time it is needed
+def get_connection():
+    """ Get the long lived database connection """
+    global _conn
+    with _db_lock:
+        if _conn is None:
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)  # Ensure the db directory exists
+            conn = create_connection(db_path)
+            if conn is None:
+                raise sqlite3.OperationalError(f"Unable to open database {db_path}")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            _conn = conn
+        return _conn
+
 # Funtion to 
 def setup_database():
     """ Setup or connect to an existing database and create table if not exists """
     logger.info("Setting up database")
-    db_path = 'db/request_times.db'
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)  # Ensure the db directory exists
-
-    conn = create_connection(db_path)
-    if conn is not None:
-        create_table_sql = '''
-        CREATE TABLE IF NOT EXISTS requests (
-            email TEXT NOT NULL,
-            last_request_time REAL NOT NULL
-        );
-        '''
+
+    create_table_sql = '''
+    CREATE TABLE IF NOT EXISTS requests (
+        email TEXT NOT NULL,
+        last_request_time REAL NOT NULL
+    );
+    '''
+    create_geocode_table_sql = '''
+    CREATE TABLE IF NOT EXISTS geocode_cache (
+        query TEXT PRIMARY KEY,
+        location TEXT NOT NULL,
+        created REAL NOT NULL,
+        last_used REAL NOT NULL
+    );
+    '''
+    create_claims_table_sql = '''
+    CREATE TABLE IF NOT EXISTS message_claims (
+        message_id TEXT PRIMARY KEY,
+        instance TEXT NOT NULL,
+        expires REAL NOT NULL
+    );
+    '''
+    create_journal_table_sql = '''
+    CREATE TABLE IF NOT EXISTS journal (
+        message_id TEXT PRIMARY KEY,
+        stage TEXT NOT NULL,
+        data TEXT NOT NULL,
+        updated REAL NOT NULL
+    );
+    '''
+    create_forecast_table_sql = '''
+    CREATE TABLE IF NOT EXISTS forecast_cache (
+        cell TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        fetched REAL NOT NULL
+    );
+    '''
+    create_subscriptions_table_sql = '''
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        email TEXT NOT NULL,
+        report_type TEXT NOT NULL,
+        compact INTEGER NOT NULL,
+        send_time TEXT NOT NULL,
+        timezone TEXT NOT NULL,
+        lat REAL NOT NULL,
+        long REAL NOT NULL,
+        units TEXT NOT NULL,
+        location TEXT NOT NULL,
+        last_sent REAL NOT NULL,
+        PRIMARY KEY (email, report_type)
+    );
+    '''
+    with _db_lock:
+        conn = get_connection()
         try:
-            c = conn.cursor()
-            c.execute(create_table_sql)
+            with conn:
+                c = conn.cursor()
+                c.execute(create_table_sql)
+                c.execute(create_geocode_table_sql)
+                c.execute("CREATE INDEX IF NOT EXISTS geocode_cache_last_used ON geocode_cache (last_used)")
+                c.execute(create_claims_table_sql)
+                c.execute(create_journal_table_sql)
+                c.execute("CREATE INDEX IF NOT EXISTS journal_updated ON journal (updated)")
+                c.execute(create_forecast_table_sql)
+                c.execute(create_subscriptions_table_sql)
+            migrate_requests_table(conn)
         except Exception as e:
             logger.error(f"Error creating table: {str(e)}")
-        finally:
-            conn.close()
+
+def migrate_requests_table(conn):
+    """ Remove duplicate senders from the requests table and add the unique index on email """
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'requests_email'")
+    if cur.fetchone():
+        return
+
+    # Older versions only ever appended rows, the highest rowid per sender is the latest request
+    logger.info("Migrating requests table to one row per sender")
+    with conn:
+        cur.execute("DELETE FROM requests WHERE rowid NOT IN (SELECT MAX(rowid) FROM requests GROUP BY email)")
+        logger.info(f"Removed {cur.rowcount} duplicate request rows")
+        cur.execute("CREATE UNIQUE INDEX requests_email ON requests (email)")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
 def get_last_request_time(email):
     """ Get the last request time of the user """
     logger.debug(f"checking last request time for {email}")
-    db_path = 'db/request_times.db'
-    conn = create_connection(db_path)
-    with conn:
-        cur = conn.cursor()
+    with _db_lock:
+        cur = get_connection().cursor()
         cur.execute("SELECT last_request_time FROM requests WHERE email = ?", (email,))
         result = cur.fetchone()
-        if result:
-            return result[0]
-    return None
+        return result[0] if result else None
 
 def update_last_request_time(email, time_stamp):
     """ Update the last request time of the user """
     logger.debug(f"setting last request time for {email} to {time_stamp}")
-    db_path = 'db/request_times.db'
-    conn = create_connection(db_path)
-    with conn:
-        cur = conn.cursor()
-        cur.execute("INSERT OR REPLACE INTO requests (email, last_request_time) VALUES (?, ?)", (email, time_stamp))
-        conn.commit()
\ No newline at end of file
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO requests (email, last_request_time) VALUES (?, ?)", (email, time_stamp))
+
+def record_request_time(email, time_stamp, rate_limit):
+    """ Record a request unless the user made one in the last rate_limit seconds, atomic across instances """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            cur = conn.execute('''
+                INSERT INTO requests (email, last_request_time) VALUES (?, ?)
+                ON CONFLICT (email) DO UPDATE SET last_request_time = excluded.last_request_time
+                WHERE requests.last_request_time <= ?''', (email, time_stamp, time_stamp - rate_limit))
+        return cur.rowcount == 1
+
+def prune_request_times(max_age):
+    """ Forget senders whose last request is older than the rate limit window """
+    cutoff = time.time() - max_age
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            cur = conn.execute("DELETE FROM requests WHERE last_request_time < ?", (cutoff,))
+    if cur.rowcount:
+        logger.debug(f"pruned {cur.rowcount} request times older than {max_age} seconds")
+
+def claim_messages(message_ids):
+    """ Claim messages for this instance, returns the ones claimed. A claim held elsewhere is only taken once its lease expired """
+    current_time = time.time()
+    claimed = set()
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            for message_id in message_ids:
+                cur = conn.execute('''
+                    INSERT INTO message_claims (message_id, instance, expires) VALUES (?, ?, ?)
+                    ON CONFLICT (message_id) DO UPDATE SET instance = excluded.instance, expires = excluded.expires
+                    WHERE message_claims.expires < ?''', (message_id, instance_id, current_time + claim_lease_ttl, current_time))
+                if cur.rowcount == 1:
+                    claimed.add(message_id)
+        _held_claims.update(claimed)
+    return claimed
+
+def renew_claims():
+    """ Extend the leases of the messages this instance is still working on """
+    with _db_lock:
+        if not _held_claims:
+            return
+        conn = get_connection()
+        with conn:
+            conn.executemany("UPDATE message_claims SET expires = ? WHERE message_id = ? AND instance = ?",
+                             [(time.time() + claim_lease_ttl, message_id, instance_id) for message_id in _held_claims])
+
+def finish_claims(message_ids):
+    """ Keep the claims of handled messages for claim_retention so instances that saw them late skip them """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            conn.executemany("UPDATE message_claims SET expires = ? WHERE message_id = ? AND instance = ?",
+                             [(time.time() + claim_retention, message_id, instance_id) for message_id in message_ids])
+        _held_claims.difference_update(message_ids)
+
+def release_claims(message_ids):
+    """ Drop the claims of messages left in the inbox so any instance can retry them """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            conn.executemany("DELETE FROM message_claims WHERE message_id = ? AND instance = ?",
+                             [(message_id, instance_id) for message_id in message_ids])
+        _held_claims.difference_update(message_ids)
+
+def prune_claims():
+    """ Remove expired claims """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            conn.execute("DELETE FROM message_claims WHERE expires < ?", (time.time(),))
+
+def get_journal(message_id):
+    """ Get the last finished stage of a message and the data saved with it, or None if it was never seen """
+    with _db_lock:
+        cur = get_connection().cursor()
+        cur.execute("SELECT stage, data FROM journal WHERE message_id = ?", (message_id,))
+        result = cur.fetchone()
+    return {'stage': result[0], 'data': json.loads(result[1])} if result else None
+
+def stage_reached(entry, stage):
+    """ Check if a journal entry from get_journal got to a stage """
+    return entry is not None and journal_stages.index(entry['stage']) >= journal_stages.index(stage)
+
+def record_stage(message_id, stage, **data):
+    """ Record that a message finished a stage, merging the data saved with it so a restart can resume there """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            cur = conn.cursor()
+            cur.execute("SELECT data FROM journal WHERE message_id = ?", (message_id,))
+            result = cur.fetchone()
+            saved = json.loads(result[0]) if result else {}
+            saved.update(data)
+            cur.execute("INSERT OR REPLACE INTO journal (message_id, stage, data, updated) VALUES (?, ?, ?, ?)",
+                        (message_id, stage, json.dumps(saved), time.time()))
+
+def record_stages(message_ids, stage):
+    """ Record that several messages finished the same stage in one transaction """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            conn.executemany("UPDATE journal SET stage = ?, updated = ? WHERE message_id = ?",
+                             [(stage, time.time(), message_id) for message_id in message_ids])
+
+def prune_journal():
+    """ Remove journal entries and stored forecasts older than their retention """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            conn.execute("DELETE FROM journal WHERE updated < ?", (time.time() - journal_retention,))
+            conn.execute("DELETE FROM forecast_cache WHERE fetched < ?", (time.time() - forecast_store_max_age,))
+
+def save_forecast(cell, data, fetched):
+    """ Store the OneCall response of a grid cell so it survives a restart """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO forecast_cache (cell, data, fetched) VALUES (?, ?, ?)",
+                         (json.dumps(cell), json.dumps(data), fetched))
+
+def load_forecast(cell):
+    """ Get the stored OneCall response of a grid cell and when it was fetched, or None """
+    with _db_lock:
+        cur = get_connection().cursor()
+        cur.execute("SELECT data, fetched FROM forecast_cache WHERE cell = ?", (json.dumps(cell),))
+        result = cur.fetchone()
+    return (json.loads(result[0]), result[1]) if result else None
+
+subscription_columns = ('email', 'report_type', 'compact', 'send_time', 'timezone', 'lat', 'long', 'units', 'location', 'last_sent')
+
+def save_subscription(subscription):
+    """ Add or replace the subscription of a user to a report type """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            conn.execute(f"INSERT OR REPLACE INTO subscriptions ({', '.join(subscription_columns)}) VALUES ({', '.join('?' * len(subscription_columns))})",
+                         [subscription[column] for column in subscription_columns])
+
+def delete_subscriptions(email, report_type=None):
+    """ Remove the subscriptions of a user, all of them unless a report type is given, returns how many were removed """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            if report_type is None:
+                cur = conn.execute("DELETE FROM subscriptions WHERE email = ?", (email,))
+            else:
+                cur = conn.execute("DELETE FROM subscriptions WHERE email = ? AND report_type = ?", (email, report_type))
+    return cur.rowcount
+
+def get_subscriptions():
+    """ Get every subscription """
+    with _db_lock:
+        cur = get_connection().cursor()
+        cur.execute(f"SELECT {', '.join(subscription_columns)} FROM subscriptions")
+        return [dict(zip(subscription_columns, row)) for row in cur.fetchall()]
+
+def mark_subscriptions_sent(keys, time_stamp):
+    """ Record when the report of each (email, report type) subscription was sent """
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            conn.executemany("UPDATE subscriptions SET last_sent = ? WHERE email = ? AND report_type = ?",
+                             [(time_stamp, email, report_type) for email, report_type in keys])
+
+# Function to renew claims and prune request times, claims and the journal in the background
+def run_maintenance(max_age, interval=db_flush_interval):
+    while True:
+        time.sleep(interval)
+        try:
+            renew_claims()
+            prune_request_times(max_age)
+            prune_claims()
+            prune_journal()
+        except Exception as e:
+            logger.error(f"Error during database maintenance: {str(e)}")
+
+# Function to start the background maintenance thread
+def start_maintenance(max_age, interval=db_flush_interval):
+    thread = threading.Thread(target=run_maintenance, args=(max_age, interval), name="db-maintenance", daemon=True)
+    thread.start()
+    return thread
+
+# Function to normalize the body text so small differences still hit the cache
+def normalize_location_query(location_content):
+    query = re.sub(r'\s+', ' ', location_content.lower()).strip()
+    return query.strip(' .,;:!?')
+
+# Function to record a geocode cache hit or miss
+def record_geocode_lookup(result):
+    metrics.inc('winlink_cache_requests_total', cache='geocode', result=result)
+
+# Function to get the geocode cache counters
+def get_geocode_stats():
+    stats = {'hit': 0, 'miss': 0}
+    stats.update(metrics.values('winlink_cache_requests_total', 'result', cache='geocode'))
+    return stats
+
+def get_cached_location(location_content, record=True):
+    """ Get the cached location (lat/long/units) for the body text if it has not expired """
+    query = normalize_location_query(location_content)
+    current_time = time.time()
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            cur = conn.cursor()
+            cur.execute("SELECT location, created FROM geocode_cache WHERE query = ?", (query,))
+            result = cur.fetchone()
+            if result and current_time - result[1] < geocode_cache_ttl:
+                cur.execute("UPDATE geocode_cache SET last_used = ? WHERE query = ?", (current_time, query))
+                if record:
+                    record_geocode_lookup('hit')
+                logger.debug(f"geocode cache hit for {query}")
+                return json.loads(result[0])
+            if result:
+                cur.execute("DELETE FROM geocode_cache WHERE query = ?", (query,))
+    if record:
+        record_geocode_lookup('miss')
+    return None
+
+def cache_location(location_content, location_data):
+    """ Store the location (lat/long/units) for the body text and evict the least recently used entries """
+    query = normalize_location_query(location_content)
+    current_time = time.time()
+    with _db_lock:
+        conn = get_connection()
+        with conn:
+            cur = conn.cursor()
+            cur.execute("INSERT OR REPLACE INTO geocode_cache (query, location, created, last_used) VALUES (?, ?, ?, ?)",
+                        (query, json.dumps(location_data), current_time, current_time))
+            cur.execute("DELETE FROM geocode_cache WHERE created < ?", (current_time - geocode_cache_ttl,))
+            cur.execute("""DELETE FROM geocode_cache WHERE query IN (
+                            SELECT query FROM geocode_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)""", (geocode_cache_size,))
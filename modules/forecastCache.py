@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import requests
+from .logger import logger
+from modules import metrics
+from modules import db
+from modules import upstream
+
+# Forecast Cache Configuration
+grid_precision = int(os.getenv('FORECAST_GRID_PRECISION', '1'))  # Decimal places of the grid cell (1 = ~11km)
+forecast_cache_size = int(os.getenv('FORECAST_CACHE_SIZE', '500'))
+forecast_ttl = {
+    'current': int(os.getenv('FORECAST_TTL_CURRENT', '600')),
+    'hourly': int(os.getenv('FORECAST_TTL_HOURLY', '1800')),
+    'daily': int(os.getenv('FORECAST_TTL_DAILY', '3600')),
+}
+forecast_stale_max = int(os.getenv('FORECAST_STALE_MAX', '21600'))  # Oldest response served while Open Weather is down
+
+# One OneCall response keeps the current, hourly and daily sections so it can serve every report type
+weather_base_url = os.getenv('WEATHER_BASE_URL', 'https://api.openweathermap.org')
+onecall_url = weather_base_url.rstrip('/') + "/data/3.0/onecall?units=imperial&exclude=minutely&lat={lat}&lon={long}&appid={appid}"
+
+# Cached responses per grid cell, oldest first
+_cache = OrderedDict()
+# Requests currently being fetched per grid cell, so concurrent misses share one upstream call
+_in_flight = {}
+_cache_lock = threading.Lock()
+
+# Function to round coordinates to the grid cell used as the cache key
+def grid_cell(lat, long):
+    return (round(float(lat), grid_precision), round(float(long), grid_precision))
+
+# Function to count a forecast cache lookup by result
+def record_lookup(result):
+    metrics.inc('winlink_cache_requests_total', cache='forecast', result=result)
+
+# Function to get the forecast cache counters
+def get_forecast_stats():
+    stats = {'hit': 0, 'prefetched': 0, 'miss': 0, 'coalesced': 0, 'stale': 0, 'stored': 0}
+    stats.update(metrics.values('winlink_cache_requests_total', 'result', cache='forecast'))
+    return stats
+
+# Function to request the full OneCall response for a grid cell
+def fetch_onecall(lat, long, weather_api_key):
+    weather_url = onecall_url.format(lat=lat, long=long, appid=weather_api_key)
+    wmap_response1 = upstream.request('openweather', 'GET', weather_url)
+    if wmap_response1.status_code == 200:
+        return wmap_response1.json()
+    logger.error(f"Failed to retrieve data from Open Weather: {wmap_response1.status_code}")
+    return None
+
+# Function to store a OneCall response for a grid cell and evict the oldest cells, also saved to the database
+def store_forecast(cell, data, fetched=None, persist=True, prefetched=False):
+    fetched = fetched if fetched is not None else time.time()
+    with _cache_lock:
+        _cache[cell] = {'data': data, 'fetched': fetched, 'prefetched': prefetched}
+        _cache.move_to_end(cell)
+        while len(_cache) > forecast_cache_size:
+            _cache.popitem(last=False)
+    if persist:
+        db.save_forecast(cell, data, fetched)
+
+# Function to get the newest response for a cell from memory or the database, whatever its age
+def saved_entry(cell):
+    with _cache_lock:
+        entry = _cache.get(cell)
+    if entry is None:
+        saved = db.load_forecast(cell)
+        if saved is not None:
+            entry = {'data': saved[0], 'fetched': saved[1]}
+    return entry
+
+# Function to get the response a request already used before a restart, so resuming it needs no upstream call
+def saved_forecast(lat, long):
+    entry = saved_entry(grid_cell(lat, long))
+    return entry['data'] if entry is not None else None
+
+# Function to return the cached response for a cell if it is fresh enough for the report type
+def _fresh_entry(cell, report_type):
+    entry = _cache.get(cell)
+    if entry is not None and time.time() - entry['fetched'] < forecast_ttl[report_type]:
+        _cache.move_to_end(cell)
+        return entry
+    return None
+
+# Function to fall back on an expired response for a cell while Open Weather cannot be reached
+def stale_forecast(cell):
+    entry = saved_entry(cell)
+    if entry is None or time.time() - entry['fetched'] >= forecast_stale_max:
+        return None
+    record_lookup('stale')
+    logger.warning(f"Serving stale forecast for cell {cell}, fetched {time.time() - entry['fetched']:.0f} seconds ago")
+    return entry['data']
+
+# Function to get the OneCall response for a location, shared by every request in the same grid cell
+def get_forecast(lat, long, report_type, weather_api_key):
+    cell = grid_cell(lat, long)
+    with _cache_lock:
+        entry = _fresh_entry(cell, report_type)
+        if entry is not None:
+            # Hits on responses the refresher fetched ahead of expiry are counted apart to show what prefetching saves
+            record_lookup('prefetched' if entry['prefetched'] else 'hit')
+            logger.info(f"Forecast cache hit for cell {cell} ({report_type})")
+            return entry['data']
+
+        flight = _in_flight.get(cell)
+        leader = flight is None
+        if leader:
+            flight = {'event': threading.Event(), 'data': None, 'error': None}
+            _in_flight[cell] = flight
+            record_lookup('miss')
+        else:
+            record_lookup('coalesced')
+
+    # Another request is already fetching this cell, wait for it instead of calling the API again
+    if not leader:
+        logger.info(f"Waiting on in-flight forecast request for cell {cell}")
+        flight['event'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['data']
+
+    try:
+        # A response saved by an earlier run is still good enough after a restart
+        saved = db.load_forecast(cell)
+        if saved is not None and time.time() - saved[1] < forecast_ttl[report_type]:
+            record_lookup('stored')
+            store_forecast(cell, saved[0], saved[1], persist=False)
+            flight['data'] = saved[0]
+            return flight['data']
+
+        logger.info(f"Forecast cache miss for cell {cell}, fetching from Open Weather")
+        try:
+            flight['data'] = fetch_onecall(cell[0], cell[1], weather_api_key)
+        except (upstream.CircuitOpenError, requests.RequestException) as e:
+            flight['data'] = stale_forecast(cell)
+            if flight['data'] is None:
+                flight['error'] = e
+                raise
+        else:
+            if flight['data'] is not None:
+                store_forecast(cell, flight['data'])
+            else:
+                flight['data'] = stale_forecast(cell)
+    finally:
+        with _cache_lock:
+            del _in_flight[cell]
+        flight['event'].set()
+    return flight['data']
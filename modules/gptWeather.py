@@ -1,9 +1,29 @@
-import requests
+import os
 import json
+import threading
 from .logger import logger
 from modules import openWeatherHelper
+from modules import locationParser
+from modules import db
+from modules import forecastCache
+from modules import upstream
+from modules import metrics
+from modules import batchGeocoder
+from modules import prefetch
 
-def generate_weather_report(location_content, oai_api_key, weather_api_key, type, oai_model='gpt-3.5-turbo-0125', oai_max_tokens=50):
+# Batch Geocoding Configuration
+geocode_batch_size = int(os.getenv('GEOCODE_BATCH_SIZE', '10'))
+geocode_batch_wait = float(os.getenv('GEOCODE_BATCH_WAIT', '1.0'))
+
+# Endpoint URL for Open AI ChatCompletion
+oai_base_url = os.getenv('OAI_BASE_URL', 'https://api.openai.com/v1')
+oai_url = f"{oai_base_url.rstrip('/')}/chat/completions"
+
+_geocoder = None
+_geocoder_lock = threading.Lock()
+
+# Function to ask Open AI for the coordinates and units in the text
+def gpt_location(location_content, oai_api_key, oai_model='gpt-3.5-turbo-0125', oai_max_tokens=50):
 
     # Headers for the HTTP request
     headers = {
@@ -24,66 +44,193 @@ def generate_weather_report(location_content, oai_api_key, weather_api_key, type
         "frequency_penalty": 0,
         "presence_penalty": 0
     }
-    
-    # Endpoint URL for Open AI ChatCompletion
-    oai_url = 'https://api.openai.com/v1/chat/completions'
 
     # Make the POST request to Open AI
-    oai_response1 = requests.post(oai_url, headers=headers, data=json.dumps(data))
+    oai_response1 = upstream.request('openai', 'POST', oai_url, headers=headers, data=json.dumps(data))
 
     # Check if the request was successful
     if oai_response1.status_code == 200:
         response_data = oai_response1.json()
         try:
             location_data = json.loads(response_data['choices'][0]['message']['content'].strip())
-            print(location_data)
-
-            latitude   = location_data['lat']
-            longitude  = location_data['long']
-            units      = location_data['units']
-        except KeyError as e:
-            logger.error(f"KeyError - {str(e)}: Necessary location data not found in the response.")
+            logger.debug(f"Location from OpenAI: {location_data}")
+        except (KeyError, IndexError, ValueError) as e:
+            logger.error(f"{type(e).__name__} - {str(e)}: Necessary location data not found in the response.")
             return None  # Exit the function if critical data is missing
 
-        # Open Weather URLs for smaller json
-        class weatherURL:
-            daily = f"https://api.openweathermap.org/data/3.0/onecall?units=imperial&exclude=current,minutely,hourly&lat={latitude}&lon={longitude}&appid={weather_api_key}"
-            current = f"https://api.openweathermap.org/data/3.0/onecall?units=imperial&exclude=daily,minutely,hourly&lat={latitude}&lon={longitude}&appid={weather_api_key}"
-            hourly = f"https://api.openweathermap.org/data/3.0/onecall?units=imperial&exclude=daily,minutely,current&lat={latitude}&lon={longitude}&appid={weather_api_key}"
-
-        # Construct the URL for weather
-        weather_url = getattr(weatherURL, type)
-
-        #Request the weather
-        wmap_response1 = requests.get(weather_url)
-
-        # Function to validate that all necessary parameters are provided
-        def validate_params(latitude, longitude, units):
-            if latitude is None or longitude is None or units is None:
-                return False
-            return True
-
-        # Check if the weather request was successful
-        if wmap_response1.status_code == 200:    
-            wmap_json_response = wmap_response1.json()
-            
-            # Validate latitude, longitude, and units before processing
-            if validate_params(latitude, longitude, units):
-                if type == "daily":
-                    forecast_report = openWeatherHelper.generate_daily_forecast(wmap_json_response, lat=latitude, long=longitude, unit=units)
-                    return forecast_report
-                if type == "current":
-                    forecast_report = openWeatherHelper.generate_current_forecast(wmap_json_response, lat=latitude, long=longitude, unit=units)
-                    return forecast_report
-                if type == "hourly":
-                    forecast_report = openWeatherHelper.generate_hourly_forecast(wmap_json_response, lat=latitude, long=longitude, unit=units)
-                    return forecast_report
-            else:
-                print("Error: Missing required parameters (latitude, longitude, or units).")
+        # An unusable answer is not returned, so it is never cached and the next request asks again
+        if not valid_location(location_data):
+            logger.error(f"Location from OpenAI is missing or invalid: {location_data}")
+            return None
+        return {'lat': location_data['lat'], 'long': location_data['long'], 'units': location_data['units']}
+    else:
+        logger.error(f"Failed to retrieve data from OpenAI: {oai_response1.status_code}")
+        return None  # Exit the function if the API call was unsuccessful
+
+# Function to check a location returned by Open AI has usable coordinates and units
+def valid_location(location_data):
+    if not isinstance(location_data, dict):
+        return False
+    try:
+        latitude = float(location_data['lat'])
+        longitude = float(location_data['long'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return -90 <= latitude <= 90 and -180 <= longitude <= 180 and location_data.get('units') in ('imperial', 'metric')
+
+# Function to ask Open AI for the coordinates and units of several texts in one request, returns {index: location}
+def gpt_locations(location_contents, oai_api_key, oai_model='gpt-3.5-turbo-0125', oai_max_tokens=50):
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {oai_api_key}'
+    }
+
+    # Each text is keyed by its index so every result can be matched and validated on its own
+    data = {
+        'model': f'{oai_model}',
+        'messages': [
+            {"role": "system", "content": "You are an expert at parsing data and finding coordinates based on input. I am going to provide you a json object that maps an index to some text containing coordinates or a location. Your job is to respond with a json object that maps every index to the coordinates for its text. You may need to lookup the coordinates if a location (city,zip code, etc) is provided. You also need to determine unit type for each text. The options are imperial and metric (watch for things like farenheit, celcius). Default to imperial if nothing is provided. Every value should ALWAYS have these parameters: lat:latitude, long:longitude, units:units"},
+            {"role": "user", "content": json.dumps({str(index): text for index, text in enumerate(location_contents)})}
+        ],
+        'max_tokens': oai_max_tokens * len(location_contents),
+        'response_format': {'type': 'json_object'},
+        "temperature": 0.5,
+        "top_p": 1,
+        "frequency_penalty": 0,
+        "presence_penalty": 0
+    }
+
+    oai_response1 = upstream.request('openai', 'POST', oai_url, headers=headers, data=json.dumps(data))
+    if oai_response1.status_code != 200:
+        logger.error(f"Failed to retrieve batch data from OpenAI: {oai_response1.status_code}")
+        return {}
+
+    response_data = oai_response1.json()
+    try:
+        batch_data = json.loads(response_data['choices'][0]['message']['content'].strip())
+    except (KeyError, IndexError, ValueError) as e:
+        logger.error(f"Batch response from OpenAI could not be parsed: {str(e)}")
+        return {}
+
+    results = {}
+    for index in range(len(location_contents)):
+        location_data = batch_data.get(str(index)) if isinstance(batch_data, dict) else None
+        if valid_location(location_data):
+            results[index] = {'lat': location_data['lat'], 'long': location_data['long'], 'units': location_data['units']}
         else:
-            print(f"Failed to retrieve data: {wmap_response1.status_code}")
+            logger.warning(f"Batch result {index} is missing or invalid: {location_data}")
+    return results
+
+# Function to get the shared batch geocoder
+def get_geocoder(oai_api_key, oai_model='gpt-3.5-turbo-0125', oai_max_tokens=50):
+    global _geocoder
+    with _geocoder_lock:
+        if _geocoder is None:
+            _geocoder = batchGeocoder.BatchGeocoder(
+                lambda location_contents: gpt_locations(location_contents, oai_api_key, oai_model=oai_model, oai_max_tokens=oai_max_tokens),
+                lambda location_content: gpt_location(location_content, oai_api_key, oai_model=oai_model, oai_max_tokens=oai_max_tokens),
+                batch_size=geocode_batch_size, batch_wait=geocode_batch_wait, on_resolved=db.cache_location,
+                on_sent=lambda count: locationParser.record_hit('llm', count))
+        return _geocoder
+
+# Function to ask Open AI for a location through the batch geocoder, results are cached as they come back
+def batched_gpt_location(location_content, oai_api_key, oai_model='gpt-3.5-turbo-0125', oai_max_tokens=50):
+    key = db.normalize_location_query(location_content)
+    return get_geocoder(oai_api_key, oai_model, oai_max_tokens).resolve(key, location_content)
+
+# Function to start geocoding every location in a fetch cycle that needs Open AI, so they share batched requests
+def prefetch_locations(location_contents, oai_api_key, oai_model='gpt-3.5-turbo-0125', oai_max_tokens=50):
+    geocoder = get_geocoder(oai_api_key, oai_model, oai_max_tokens)
+    for location_content in location_contents:
+        if not location_content or locationParser.parse_location(location_content, record=False) is not None:
+            continue
+        if db.get_cached_location(location_content, record=False) is None:
+            geocoder.submit(db.normalize_location_query(location_content), location_content)
 
+# Function to send the locations waiting for Open AI now, once a fetch cycle has submitted all of them
+def flush_locations(oai_api_key, oai_model='gpt-3.5-turbo-0125', oai_max_tokens=50):
+    get_geocoder(oai_api_key, oai_model, oai_max_tokens).flush()
 
+# Function to resolve the location, trying the local parser before falling back to Open AI
+def resolve_location(location_content, oai_api_key, oai_model='gpt-3.5-turbo-0125', oai_max_tokens=50):
+    location_data = locationParser.parse_location(location_content)
+    if location_data is None:
+        location_data = cached_gpt_location(location_content, oai_api_key, oai_model=oai_model, oai_max_tokens=oai_max_tokens)
+
+    stats = locationParser.get_parse_stats()
+    total = sum(stats.values())
+    logger.info(f"Location parser stats: {stats} ({total - stats['llm']} of {total} requests skipped OpenAI)")
+    return location_data
+
+# Function to look up the location in the geocode cache before asking Open AI
+def cached_gpt_location(location_content, oai_api_key, oai_model='gpt-3.5-turbo-0125', oai_max_tokens=50):
+    location_data = db.get_cached_location(location_content)
+    if location_data is None:
+        location_data = batched_gpt_location(location_content, oai_api_key, oai_model=oai_model, oai_max_tokens=oai_max_tokens)
+
+    stats = db.get_geocode_stats()
+    lookups = stats['hit'] + stats['miss']
+    logger.info(f"Geocode cache stats: {stats['hit']} hits, {stats['miss']} misses ({stats['hit'] / lookups:.0%} hit ratio)")
+    return location_data
+
+# Function to render a report from a OneCall response, returns None for an unknown report type
+def render_report(wmap_json_response, type, latitude, longitude, units, compact=False, byte_budget=None):
+    with metrics.stage('render'):
+        if compact:
+            forecast_report = openWeatherHelper.generate_compact_forecast(wmap_json_response, type, lat=latitude, long=longitude, unit=units, byte_budget=byte_budget)
+        elif type == "daily":
+            forecast_report = openWeatherHelper.generate_daily_forecast(wmap_json_response, lat=latitude, long=longitude, unit=units)
+        elif type == "current":
+            forecast_report = openWeatherHelper.generate_current_forecast(wmap_json_response, lat=latitude, long=longitude, unit=units)
+        elif type == "hourly":
+            forecast_report = openWeatherHelper.generate_hourly_forecast(wmap_json_response, lat=latitude, long=longitude, unit=units)
+        else:
+            return None
+    logger.info(f"Rendered {'compact ' if compact else ''}{type} report: {len(forecast_report.encode('utf-8'))} bytes")
+    return forecast_report
+
+def generate_weather_report(location_content, oai_api_key, weather_api_key, type, oai_model='gpt-3.5-turbo-0125', oai_max_tokens=50, compact=False, byte_budget=None, journal_key=None):
+
+    # A request resumed after a restart reuses the stages its journal says were finished
+    journal = db.get_journal(journal_key) if journal_key else None
+
+    # Resolve the coordinates and units for the request
+    with metrics.stage('geocode'):
+        location_data = journal['data'].get('location') if db.stage_reached(journal, 'geocoded') else None
+        if location_data is None:
+            location_data = resolve_location(location_content, oai_api_key, oai_model=oai_model, oai_max_tokens=oai_max_tokens)
+            if journal_key and location_data is not None:
+                db.record_stage(journal_key, 'geocoded', location=location_data)
+    if location_data is None:
+        return None  # Exit the function if the location could not be resolved
+
+    latitude   = location_data['lat']
+    longitude  = location_data['long']
+    units      = location_data['units']
+
+    # Count the request for its grid cell so the hottest cells are fetched again before they expire
+    prefetch.record_request(latitude, longitude, type)
+
+    # Request the weather, one OneCall response per grid cell serves every report type
+    with metrics.stage('weather'):
+        wmap_json_response = forecastCache.saved_forecast(latitude, longitude) if db.stage_reached(journal, 'fetched') else None
+        if wmap_json_response is None:
+            wmap_json_response = forecastCache.get_forecast(latitude, longitude, type, weather_api_key)
+            if journal_key and wmap_json_response is not None:
+                db.record_stage(journal_key, 'fetched')
+
+    # Function to validate that all necessary parameters are provided
+    def validate_params(latitude, longitude, units):
+        if latitude is None or longitude is None or units is None:
+            return False
+        return True
+
+    # Check if the weather request was successful
+    if wmap_json_response is not None:
+        # Validate latitude, longitude, and units before processing
+        if validate_params(latitude, longitude, units):
+            return render_report(wmap_json_response, type, latitude, longitude, units, compact=compact, byte_budget=byte_budget)
+        else:
+            logger.error("Missing required parameters (latitude, longitude, or units).")
     else:
-        logger.error(f"Failed to retrieve data from OpenAI: {oai_response1.status_code}")
-        return None  # Exit the function if the API call was unsuccessful
\ No newline at end of file
+        logger.error("Failed to retrieve data from Open Weather.")
@@ -0,0 +1,183 @@
+import re
+import select
+import ssl
+import time
+
+# Tokens in an IMAP response: parens, quoted strings and atoms (which may carry a [section] and <partial>)
+token_pattern = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[]*\[[^\]]*\](?:<\d+>)?|[^\s()"]+))')
+literal_marker = re.compile(rb'\{(\d+)\}\s*$')
+
+# Marks a literal ({n} followed by raw bytes) so it is not confused with an atom
+class Literal(bytes):
+    pass
+
+# Function to split one piece of response text into tokens
+def tokenize_text(text):
+    tokens = []
+    for match in token_pattern.finditer(text):
+        open_paren, close_paren, quoted, atom = match.groups()
+        if open_paren:
+            tokens.append('(')
+        elif close_paren:
+            tokens.append(')')
+        elif quoted is not None:
+            tokens.append(Literal(re.sub(rb'\\(.)', rb'\1', quoted)))
+        elif atom:
+            tokens.append(atom)
+    return tokens
+
+# Function to flatten the data returned by imaplib into tokens, with literals spliced back in
+def tokenize_response(data):
+    tokens = []
+    for item in data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            head, literal = item
+            tokens.extend(tokenize_text(literal_marker.sub(b'', head)))
+            tokens.append(Literal(literal))
+        else:
+            tokens.extend(tokenize_text(item))
+    return tokens
+
+# Function to build nested lists from tokens, NIL becomes None
+def parse_tokens(tokens):
+    stack = [[]]
+    for token in tokens:
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+        elif not isinstance(token, Literal) and token.upper() == b'NIL':
+            stack[-1].append(None)
+        else:
+            stack[-1].append(token)
+    while len(stack) > 1:
+        finished = stack.pop()
+        stack[-1].append(finished)
+    return stack[0]
+
+# Function to parse a (UID) FETCH response into one dict per message keyed on the upper case item name
+def parse_fetch_response(data):
+    messages = []
+    for item in parse_tokens(tokenize_response(data)):
+        if not isinstance(item, list):
+            continue  # Message sequence number
+        message = {}
+        for index in range(0, len(item) - 1, 2):
+            key = item[index]
+            if isinstance(key, bytes):
+                message[key.decode('ascii', 'replace').upper()] = item[index + 1]
+        if 'UID' in message:
+            message['UID'] = int(message['UID'])
+        messages.append(message)
+    return messages
+
+# Function to turn a list of UIDs into a compact UID set, eg [1, 2, 3, 7] -> "1:3,7"
+def uid_set(uids):
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+# Function to find the first text/plain part in a BODYSTRUCTURE, returns (part number, encoding, charset) or None
+def find_text_part(structure, part_number=''):
+    if not isinstance(structure, list) or not structure:
+        return None
+
+    # Multipart bodies start with their child parts, followed by the subtype
+    if isinstance(structure[0], list):
+        children = []
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            children.append(child)
+        for index, child in enumerate(children, 1):
+            found = find_text_part(child, f"{part_number}.{index}" if part_number else str(index))
+            if found is not None:
+                return found
+        return None
+
+    if len(structure) < 6 or not isinstance(structure[0], bytes) or not isinstance(structure[1], bytes):
+        return None
+    if structure[0].lower() != b'text' or structure[1].lower() != b'plain':
+        return None
+
+    charset = 'utf-8'
+    params = structure[2] if isinstance(structure[2], list) else []
+    for index in range(0, len(params) - 1, 2):
+        if isinstance(params[index], bytes) and params[index].lower() == b'charset' and params[index + 1]:
+            charset = params[index + 1].decode('ascii', 'replace')
+    encoding = structure[5].decode('ascii', 'replace').lower() if structure[5] else '7bit'
+
+    # A single part message is addressed as part 1
+    return part_number or '1', encoding, charset
+
+# Function to find the value of a fetched section, eg "BODY[HEADER" matches "BODY[HEADER.FIELDS (FROM)]"
+def fetched_section(fetched, prefix):
+    for key, value in fetched.items():
+        if key.startswith(prefix):
+            return value
+    return None
+
+# Function to check if the server supports IMAP IDLE (RFC 2177)
+def supports_idle(mail):
+    return 'IDLE' in mail.capabilities
+
+# Function to take the new mail announcements the server sent in replies to earlier commands, returns True if there were any
+def new_mail_pending(mail):
+    return mail.untagged_responses.pop('EXISTS', None) is not None
+
+# Function to check for response data imaplib has already read off the socket, select cannot see it
+def buffered(mail):
+    timeout = mail.sock.gettimeout()
+    mail.sock.setblocking(False)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.settimeout(timeout)
+
+# Function to wait in IDLE until the server reports new mail or the timeout passes, returns True on new mail
+def idle_wait(mail, timeout):
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    response = mail.readline()
+    if not response.startswith(b'+'):
+        raise mail.error(f"IDLE not accepted: {response.strip().decode('ascii', 'replace')}")
+
+    new_mail = False
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # Data already buffered by imaplib or decrypted by the SSL layer does not show up in select
+        pending = getattr(mail.sock, 'pending', None)
+        if not (pending and pending()) and not buffered(mail):
+            readable, _, _ = select.select([mail.sock], [], [], remaining)
+            if not readable:
+                break
+        line = mail.readline()
+        if not line:
+            raise mail.abort("connection closed during IDLE")
+        new_mail = b'EXISTS' in line.upper()
+
+    # End the IDLE command and read up to its tagged completion
+    mail.send(b'DONE\r\n')
+    while True:
+        line = mail.readline()
+        if not line:
+            raise mail.abort("connection closed while ending IDLE")
+        if line.startswith(tag):
+            if not line[len(tag):].strip().upper().startswith(b'OK'):
+                raise mail.error(f"IDLE failed: {line.strip().decode('ascii', 'replace')}")
+            return new_mail
+        new_mail = new_mail or b'EXISTS' in line.upper()
@@ -0,0 +1,201 @@
+import os
+import re
+import threading
+from .logger import logger
+from modules import metrics
+
+# Optional US ZIP gazetteer (Census "ZCTA" gazetteer text file) used to resolve ZIP codes offline
+zip_gazetteer_path = os.getenv('ZIP_GAZETTEER')
+
+# Unit keywords, anything else defaults to imperial like the GPT prompt does
+metric_keywords = re.compile(r'\b(metric|celsius|celcius|centigrade|kph|km/h)\b|°\s*c\b', re.IGNORECASE)
+imperial_keywords = re.compile(r'\b(imperial|fahrenheit|farenheit|mph)\b|°\s*f\b', re.IGNORECASE)
+
+# Decimal number optionally wrapped in hemisphere letters, eg "-95.37", "29.76N", "W 95.37"
+decimal_pattern = re.compile(
+    r'(?<![\w.])([NSEWnsew](?![a-zA-Z]))?\s*([-+]?\d{1,3}(?:\.\d+)?)\s*°?\s*([NSEWnsew](?![a-zA-Z]))?(?![\w.])'
+)
+
+# Words that may surround a decimal pair, any other text means the numbers could be something else (eg "I-10 exit 24.5")
+coordinate_filler = re.compile(
+    r'\b(lat|latitude|lon|long|longitude|lng|coords?|coordinates|gps|position|location|weather|forecast|'
+    r'provide|send|give|me|please|for|at|in|of|the|and|using|use|units?|system|format)\b|[\s,;/():=°]',
+    re.IGNORECASE
+)
+
+# Degrees, minutes and optional seconds with a required hemisphere, eg 40°26'46"N 79°58'56"W
+dms_part = r'(\d{1,3})\s*[°º:d\s]\s*(\d{1,2}(?:\.\d+)?)\s*[\'′:m]?\s*(?:(\d{1,2}(?:\.\d+)?)\s*(?:"|″|\'\'|s)?)?\s*'
+dms_pattern = re.compile(dms_part + r'([NSns])[\s,;/]*' + dms_part + r'([EWew])')
+
+# Maidenhead grid locator with 4, 6 or 8 characters, eg EM10, EM10dh, EM10dh45
+maidenhead_pattern = re.compile(r'(?<![\w])([A-Ra-r]{2}[0-9]{2}(?:[A-Xa-x]{2}(?:[0-9]{2})?)?)(?![\w])')
+
+# Five digit US ZIP code
+zip_pattern = re.compile(r'(?<![\w.-])(\d{5})(?:-\d{4})?(?![\w.])')
+
+# Paths that can resolve a request, "llm" counts bodies that still had to be sent to OpenAI
+parse_paths = ('decimal', 'dms', 'maidenhead', 'zip', 'llm')
+
+_zip_table = None
+_zip_table_lock = threading.Lock()
+
+# Function to count which path resolved a request
+def record_hit(path, count=1):
+    metrics.inc('winlink_location_parse_total', count, path=path)
+
+# Function to get the hit counters per path
+def get_parse_stats():
+    stats = dict.fromkeys(parse_paths, 0)
+    stats.update(metrics.values('winlink_location_parse_total', 'path'))
+    return stats
+
+# Function to determine the unit type from keywords in the text
+def parse_units(text):
+    metric = metric_keywords.search(text)
+    imperial = imperial_keywords.search(text)
+    if metric and (not imperial or metric.start() < imperial.start()):
+        return 'metric'
+    return 'imperial'
+
+# Function to validate coordinates are on the globe
+def valid_coordinates(lat, long):
+    return -90.0 <= lat <= 90.0 and -180.0 <= long <= 180.0
+
+# Function to parse a pair of decimal coordinates, only when the text holds exactly one unambiguous pair
+def parse_decimal(text):
+    matches = list(decimal_pattern.finditer(text))
+    if len(matches) != 2:
+        return None
+
+    values = []
+    for match in matches:
+        prefix, number, suffix = match.groups()
+        if prefix and suffix:
+            return None
+        hemisphere = (prefix or suffix or '').upper()
+        value = float(number)
+        if hemisphere in ('S', 'W'):
+            value = -abs(value)
+        values.append((value, hemisphere, '.' in number))
+
+    (lat, lat_hemisphere, lat_decimal), (long, long_hemisphere, long_decimal) = values
+
+    # Plain integers are too easy to confuse with house numbers, road numbers or ZIP fragments
+    if not ((lat_decimal or lat_hemisphere) and (long_decimal or long_hemisphere)):
+        return None
+
+    # Anything but separators, labels and unit keywords around the pair (eg "Apt 4, 12.5 Main St") goes to OpenAI
+    rest = decimal_pattern.sub('', text)
+    rest = imperial_keywords.sub('', metric_keywords.sub('', rest))
+    if coordinate_filler.sub('', rest):
+        return None
+
+    # Hemisphere letters can put longitude first, eg "95.37W 29.76N"
+    if lat_hemisphere in ('E', 'W') and long_hemisphere in ('N', 'S'):
+        lat, long = long, lat
+    elif lat_hemisphere in ('E', 'W') or long_hemisphere in ('N', 'S'):
+        return None
+
+    if not valid_coordinates(lat, long):
+        return None
+    return lat, long
+
+# Function to convert one degrees/minutes/seconds group into decimal degrees
+def dms_to_decimal(degrees, minutes, seconds, hemisphere):
+    value = float(degrees) + float(minutes) / 60 + float(seconds or 0) / 3600
+    if hemisphere.upper() in ('S', 'W'):
+        value = -value
+    return round(value, 6)
+
+# Function to parse degrees, minutes, seconds coordinates
+def parse_dms(text):
+    match = dms_pattern.search(text)
+    if not match:
+        return None
+    lat_d, lat_m, lat_s, lat_h, long_d, long_m, long_s, long_h = match.groups()
+    if float(lat_m) >= 60 or float(long_m) >= 60 or float(lat_s or 0) >= 60 or float(long_s or 0) >= 60:
+        return None
+    lat = dms_to_decimal(lat_d, lat_m, lat_s, lat_h)
+    long = dms_to_decimal(long_d, long_m, long_s, long_h)
+    if not valid_coordinates(lat, long):
+        return None
+    return lat, long
+
+# Function to convert a Maidenhead locator to the coordinates of the center of its square
+def maidenhead_to_coordinates(locator):
+    locator = locator.upper()
+    long = (ord(locator[0]) - ord('A')) * 20 - 180
+    lat = (ord(locator[1]) - ord('A')) * 10 - 90
+    long += int(locator[2]) * 2
+    lat += int(locator[3])
+    long_size, lat_size = 2.0, 1.0
+
+    if len(locator) >= 6:
+        long_size, lat_size = long_size / 24, lat_size / 24
+        long += (ord(locator[4]) - ord('A')) * long_size
+        lat += (ord(locator[5]) - ord('A')) * lat_size
+    if len(locator) == 8:
+        long_size, lat_size = long_size / 10, lat_size / 10
+        long += int(locator[6]) * long_size
+        lat += int(locator[7]) * lat_size
+
+    return round(lat + lat_size / 2, 4), round(long + long_size / 2, 4)
+
+# Function to parse a Maidenhead grid locator, only when it is the only locator and no other numbers are present
+def parse_maidenhead(text):
+    matches = maidenhead_pattern.findall(text)
+    if len(matches) != 1:
+        return None
+    if re.search(r'\d', maidenhead_pattern.sub('', text)):
+        return None
+    return maidenhead_to_coordinates(matches[0])
+
+# Function to load the ZIP gazetteer into memory the first time it is needed
+def load_zip_table():
+    global _zip_table
+    if _zip_table is None:
+        with _zip_table_lock:
+            if _zip_table is None:
+                table = {}
+                if zip_gazetteer_path:
+                    try:
+                        with open(zip_gazetteer_path, encoding='utf-8') as gazetteer:
+                            header = [column.strip() for column in gazetteer.readline().split('\t')]
+                            zip_column, lat_column, long_column = header.index('GEOID'), header.index('INTPTLAT'), header.index('INTPTLONG')
+                            for line in gazetteer:
+                                columns = line.split('\t')
+                                table[columns[zip_column].strip()] = (float(columns[lat_column]), float(columns[long_column]))
+                        logger.info(f"Loaded {len(table)} ZIP codes from {zip_gazetteer_path}")
+                    except (OSError, ValueError, IndexError) as e:
+                        logger.error(f"Error loading ZIP gazetteer {zip_gazetteer_path}: {str(e)}")
+                _zip_table = table
+    return _zip_table
+
+# Function to resolve a US ZIP code using the gazetteer, only when it is the only number in the text
+def parse_zip(text):
+    matches = zip_pattern.findall(text)
+    if len(matches) != 1 or re.search(r'\d', zip_pattern.sub('', text)):
+        return None
+    return load_zip_table().get(matches[0])
+
+# Parsers in the order they are tried, DMS first since its parts also look like decimals
+parsers = [
+    ('dms', parse_dms),
+    ('decimal', parse_decimal),
+    ('maidenhead', parse_maidenhead),
+    ('zip', parse_zip),
+]
+
+# Function to parse a location locally, returns the same shape as the GPT response or None
+def parse_location(text, record=True):
+    if not text:
+        return None
+    for path, parser in parsers:
+        coordinates = parser(text)
+        if coordinates is not None:
+            lat, long = coordinates
+            if record:
+                record_hit(path)
+                logger.info(f"Location parsed locally via {path}: {lat}, {long}")
+            return {'lat': lat, 'long': long, 'units': parse_units(text)}
+    return None
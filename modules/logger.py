@@ -1,14 +1,54 @@
 import logging
 import os
+import json
+import contextvars
+from contextlib import contextmanager
 
 # Default to INFO if no environment variable is set
 log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
 numeric_level = getattr(logging, log_level, None)
 if not isinstance(numeric_level, int):
     raise ValueError(f'Invalid log level: {log_level}')
+log_format = os.getenv('LOG_FORMAT', 'text').lower()  # text or json
+
+# Correlation ID of the request being handled, every thread and pipeline stage carries its own
+correlation_id = contextvars.ContextVar('correlation_id', default='-')
+
+# Add the correlation ID of the current request to every log record
+class CorrelationFilter(logging.Filter):
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+# Write each log record as one JSON object
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'correlation_id': record.correlation_id,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
 
 # Setup Logging
-logging.basicConfig(level=numeric_level, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=numeric_level, format='%(asctime)s - %(levelname)s - [%(correlation_id)s] %(message)s')
+for handler in logging.getLogger().handlers:
+    handler.addFilter(CorrelationFilter())
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+
+# Tag the log lines written inside the block with the correlation ID of a request
+@contextmanager
+def correlation(value):
+    token = correlation_id.set(value)
+    try:
+        yield
+    finally:
+        correlation_id.reset(token)
 
 # Export the logger
 logger = logging.getLogger(__name__)
\ No newline at end of file
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .logger import logger
+
+# Metrics Configuration
+metrics_port = int(os.getenv('METRICS_PORT', '9110'))  # 0 disables the endpoint
+metrics_host = os.getenv('METRICS_HOST', '0.0.0.0')
+admin_routes = os.getenv('METRICS_ADMIN_ROUTES', 'false').lower() == 'true'  # /debug/* routes are not authenticated, off by default
+
+# Upper bounds in seconds of the duration histogram buckets
+duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Every metric the app records: name -> (type, help)
+definitions = {
+    'winlink_stage_duration_seconds': ('histogram', "Time spent in each stage of handling a request"),
+    'winlink_emails_total': ('counter', "Emails handled by outcome"),
+    'winlink_replies_total': ('counter', "Requests finished by the pipeline by outcome"),
+    'winlink_cache_requests_total': ('counter', "Forecast and geocode cache lookups by result, prefetched counts hits on refreshed-ahead forecasts"),
+    'winlink_location_parse_total': ('counter', "Locations resolved by each parser, llm counts those sent to Open AI"),
+    'winlink_upstream_requests_total': ('counter', "Upstream HTTP requests by provider and status"),
+    'winlink_upstream_errors_total': ('counter', "Upstream failures by provider and reason"),
+    'winlink_upstream_duration_seconds': ('histogram', "Upstream HTTP request latency by provider"),
+    'winlink_pipeline_in_flight': ('gauge', "Requests submitted to the pipeline and not yet delivered"),
+    'winlink_scheduled_reports_total': ('counter', "Subscription reports by outcome"),
+    'winlink_prefetch_total': ('counter', "Refresh-ahead fetches of hot grid cells by outcome"),
+    'winlink_hotspot_requests': ('gauge', "Decayed request count of the hottest grid cells"),
+}
+
+# Recorded values: name -> {label pairs: value}, histograms keep [bucket counts, sum, count]
+_values = {name: {} for name in definitions}
+_lock = threading.Lock()
+
+# Extra paths served by the metrics endpoint: path -> function returning (status, content type, body)
+routes = {}
+
+_server = None
+
+# Function to turn keyword labels into a hashable key in a stable order
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+# Function to add to a counter
+def inc(name, amount=1, **labels):
+    key = label_key(labels)
+    with _lock:
+        _values[name][key] = _values[name].get(key, 0) + amount
+
+# Function to set a gauge
+def set_gauge(name, value, **labels):
+    with _lock:
+        _values[name][label_key(labels)] = value
+
+# Function to drop every recorded value of a metric, eg a gauge whose label set is rebuilt each time
+def clear(name):
+    with _lock:
+        _values[name].clear()
+
+# Function to record one observation in a histogram
+def observe(name, value, **labels):
+    key = label_key(labels)
+    with _lock:
+        state = _values[name].get(key)
+        if state is None:
+            state = _values[name][key] = [[0] * len(duration_buckets), 0.0, 0]
+        for index, bound in enumerate(duration_buckets):
+            if value <= bound:
+                state[0][index] += 1
+        state[1] += value
+        state[2] += 1
+
+# Time a block and record it in a histogram
+@contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+# Time a block as one stage of handling a request
+def stage(stage_name):
+    return timed('winlink_stage_duration_seconds', stage=stage_name)
+
+# Function to get the values of a counter keyed on one of its labels, summed over the others
+def values(name, label, **match):
+    wanted = set(label_key(match))
+    totals = {}
+    with _lock:
+        for key, value in _values[name].items():
+            if wanted.issubset(key):
+                label_value = dict(key).get(label)
+                totals[label_value] = totals.get(label_value, 0) + value
+    return totals
+
+# Function to escape a label value for the Prometheus text format
+def escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+# Function to format a metric name with its labels
+def sample(name, key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return name
+    return name + '{' + ','.join(f'{label}="{escape(value)}"' for label, value in pairs) + '}'
+
+# Function to render every metric in the Prometheus text exposition format
+def render():
+    lines = []
+    with _lock:
+        for name, (metric_type, help_text) in definitions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for key, value in sorted(_values[name].items()):
+                if metric_type != 'histogram':
+                    lines.append(f"{sample(name, key)} {value}")
+                    continue
+                bucket_counts, total, count = value
+                for bound, bucket_count in zip(duration_buckets, bucket_counts):
+                    lines.append(f"{sample(name + '_bucket', key, [('le', str(bound))])} {bucket_count}")
+                lines.append(f"{sample(name + '_bucket', key, [('le', '+Inf')])} {count}")
+                lines.append(f"{sample(name + '_sum', key)} {total}")
+                lines.append(f"{sample(name + '_count', key)} {count}")
+    return '\n'.join(lines) + '\n'
+
+routes['/metrics'] = lambda: (200, 'text/plain; version=0.0.4; charset=utf-8', render())
+
+# Function to register an admin route, only served when METRICS_ADMIN_ROUTES is on
+def add_admin_route(path, route):
+    if admin_routes:
+        routes[path] = route
+
+# Serves the registered routes, anything else is a 404
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        route = routes.get(self.path.split('?')[0])
+        if route is None:
+            status, content_type, body = 404, 'text/plain; charset=utf-8', "Not found\n"
+        else:
+            status, content_type, body = route()
+        payload = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(f"metrics endpoint: {format % args}")
+
+# Function to start the metrics endpoint in the background
+def start_server(port=metrics_port, host=metrics_host):
+    global _server
+    if not port or _server is not None:
+        return _server
+    try:
+        _server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logger.error(f"Could not start the metrics endpoint on port {port}: {str(e)}")
+        return None
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return _server
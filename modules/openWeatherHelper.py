@@ -1,4 +1,8 @@
+import io
+import os
+import threading
 from datetime import datetime
+from functools import lru_cache
 from timezonefinder import TimezoneFinder
 import pytz
 
@@ -20,163 +24,346 @@ def convert_wind_speed(speed, unit):
 def mm_to_inches(mm):
     return mm / 25.4
 
+# Shared TimezoneFinder, loading the polygon data is expensive so only do it once per process
+_timezone_finder = None
+_timezone_finder_lock = threading.Lock()
+
+# Decimal places used to round coordinates before caching their timezone (~1km)
+timezone_cache_precision = int(os.getenv('TIMEZONE_CACHE_PRECISION', '2'))
+
+# Function to get (or create) the process wide TimezoneFinder
+def get_timezone_finder():
+    global _timezone_finder
+    if _timezone_finder is None:
+        with _timezone_finder_lock:
+            if _timezone_finder is None:
+                _timezone_finder = TimezoneFinder()
+    return _timezone_finder
+
+# Function to load the timezone data at startup so the first request does not pay for it
+def warm_timezone_finder():
+    get_timezone_finder().timezone_at(lat=0.0, lng=0.0)
+
+# Function to resolve a timezone for rounded coordinates, cached per process
+@lru_cache(maxsize=int(os.getenv('TIMEZONE_CACHE_SIZE', '1024')))
+def _lookup_timezone(lat, long):
+    timezone_str = get_timezone_finder().timezone_at(lat=lat, lng=long)  # Get timezone string from coordinates
+    if timezone_str is None:
+        raise ValueError("Invalid coordinates for timezone determination")
+    return pytz.timezone(timezone_str)
+
 # Function to find the timezone based on latitude and longitude
 def get_timezone(lat, long):
-    tf = TimezoneFinder()
     try:
         # Convert lat and long to float if they are not already
         lat = float(lat)
         long = float(long)
     except ValueError:
         raise ValueError("Latitude and Longitude must be convertible to float")
-        
-    timezone_str = tf.timezone_at(lat=lat, lng=long)  # Get timezone string from coordinates
-    if timezone_str is None:
-        raise ValueError("Invalid coordinates for timezone determination")
-    return pytz.timezone(timezone_str)
 
-# Function to convert UTC timestamp to local date using latitude and longitude
-def get_date(timestamp, lat, long):
-    timezone = get_timezone(lat, long)
-    utc_time = datetime.utcfromtimestamp(timestamp)
-    local_time = utc_time.replace(tzinfo=pytz.utc).astimezone(timezone)
-    return local_time.strftime('%A, %B %d, %Y')
+    return _lookup_timezone(round(lat, timezone_cache_precision), round(long, timezone_cache_precision))
+
+# Unit labels and converters, worked out once per unit instead of on every field
+unit_formats = {
+    'imperial': {
+        'temp': lambda temp: f"{convert_temperature(temp, 'imperial'):.1f}°F",
+        'wind': lambda speed: f"{convert_wind_speed(speed, 'imperial'):.1f} mph",
+        'rain': lambda rain_mm: f"{mm_to_inches(rain_mm):.2f} inches",
+    },
+    'metric': {
+        'temp': lambda temp: f"{convert_temperature(temp, 'metric'):.1f}°C",
+        'wind': lambda speed: f"{convert_wind_speed(speed, 'metric'):.1f} km/h",
+        'rain': lambda rain_mm: f"{rain_mm:.1f} mm",
+    },
+}
+
+# Field specs per report type: (label, path into the Open Weather entry, kind of value)
+weather_fields = [
+    ('Humidity', ('humidity',), 'percent'),
+    ('Weather', ('weather', 0, 'description'), 'text'),
+    ('Wind Speed', ('wind_speed',), 'wind'),
+]
+report_specs = {
+    'daily': {
+        'title': "Weather Forecast for {lat}, {long}:\n\n",
+        'section': 'daily',
+        'fields': [
+            ('Date', ('dt',), 'date'),
+            ('Summary', ('summary',), 'text'),
+            ('Day Temperature', ('temp', 'day'), 'temp'),
+            ('Min Temperature', ('temp', 'min'), 'temp'),
+            ('Max Temperature', ('temp', 'max'), 'temp'),
+        ] + weather_fields,
+        'rain': ('rain',),
+        'rain_note': '',
+        'alert_date': 'date',
+    },
+    'current': {
+        'title': "Current Weather Forecast for {lat}, {long} on {date}:\n\n",
+        'section': 'current',
+        'fields': [
+            ('Temperature', ('temp',), 'temp'),
+            ('Feels Like', ('feels_like',), 'temp'),
+        ] + weather_fields,
+        'rain': ('rain', '1h'),
+        'rain_note': ' (last hour)',
+        'alert_date': 'date',
+    },
+    'hourly': {
+        'title': "Hourly Weather Forecast for {lat}, {long}:\n\n",
+        'section': 'hourly',
+        'fields': [
+            ('Date & Time', ('dt',), 'datetime'),
+            ('Temperature', ('temp',), 'temp'),
+            ('Feels Like', ('feels_like',), 'temp'),
+        ] + weather_fields,
+        'rain': ('rain', '1h'),
+        'rain_note': '',
+        'alert_date': 'datetime',
+    },
+}
 
-# Function to convert UTC timestamp to local date and time using latitude and longitude
-def get_date_time(timestamp, lat, long):
+# Function to build a getter for a field path, missing keys give None
+def field_getter(path):
+    if len(path) == 1:
+        key = path[0]
+        return lambda entry: entry.get(key)
+
+    def get(entry):
+        for key in path:
+            try:
+                entry = entry[key]
+            except (KeyError, IndexError, TypeError):
+                return None
+        return entry
+    return get
+
+# Compiled row specs per report type: (line prefix, getter, kind)
+compiled_fields = {
+    report_type: [(f"{label}: ", field_getter(path), kind) for label, path, kind in spec['fields']]
+    for report_type, spec in report_specs.items()
+}
+compiled_rain = {report_type: field_getter(spec['rain']) for report_type, spec in report_specs.items()}
+
+# Function to write a forecast report to any text stream (io.StringIO, a file, ...)
+def write_forecast(out, data, report_type, lat, long, unit='imperial'):
+    spec = report_specs[report_type]
     timezone = get_timezone(lat, long)
-    utc_time = datetime.utcfromtimestamp(timestamp)
-    local_time = utc_time.replace(tzinfo=pytz.utc).astimezone(timezone)
-    return local_time.strftime('%A, %B %d, %Y at %H:%M')
+    unit_format = unit_formats.get(unit, unit_formats['imperial'])
+    formatters = {
+        'date': lambda timestamp: datetime.fromtimestamp(timestamp, timezone).strftime('%A, %B %d, %Y'),
+        'datetime': lambda timestamp: datetime.fromtimestamp(timestamp, timezone).strftime('%A, %B %d, %Y at %H:%M'),
+        'temp': unit_format['temp'],
+        'wind': unit_format['wind'],
+        'percent': lambda value: f"{value}%",
+        'text': lambda value: f"{value}",
+    }
+    rows = [(prefix, get, formatters[kind]) for prefix, get, kind in compiled_fields[report_type]]
+    get_rain = compiled_rain[report_type]
+    format_rain = unit_format['rain']
+    rain_line_end = spec['rain_note'] + "\n"
 
-# Function to parse daily forcast output from Open Weather
-def generate_daily_forecast(data, lat, long, unit='imperial'):
-    email_forecast = f"Weather Forecast for {lat}, {long}:\n\n"
-    for day in data["daily"]:
-        date = get_date(day["dt"], lat=lat, long=long)
-        summary = day["summary"]
-        temp_day = convert_temperature(day["temp"]["day"], unit)
-        temp_min = convert_temperature(day["temp"]["min"], unit)
-        temp_max = convert_temperature(day["temp"]["max"], unit)
-        humidity = day["humidity"]
-        wind_speed = convert_wind_speed(day["wind_speed"], unit)
-        description = day["weather"][0]["description"]
-
-        email_forecast += f"Date: {date}\n"
-        email_forecast += f"Summary: {summary}\n"
-        email_forecast += f"Day Temperature: {temp_day:.1f}°{'C' if unit == 'metric' else 'F'}\n"
-        email_forecast += f"Min Temperature: {temp_min:.1f}°{'C' if unit == 'metric' else 'F'}\n"
-        email_forecast += f"Max Temperature: {temp_max:.1f}°{'C' if unit == 'metric' else 'F'}\n"
-        email_forecast += f"Humidity: {humidity}%\n"
-        email_forecast += f"Weather: {description}\n"
-        email_forecast += f"Wind Speed: {wind_speed:.1f} {'km/h' if unit == 'metric' else 'mph'}\n"
-        if "rain" in day:
-            rain_mm = day["rain"]
-            if unit == 'imperial':
-                rain_inches = mm_to_inches(rain_mm)
-                email_forecast += f"Rain: {rain_inches:.2f} inches\n"
-            else:
-                email_forecast += f"Rain: {rain_mm:.1f} mm\n"
-
-        email_forecast += "---\n\n"
-
-    # Adding alerts to the forecast
-    if "alerts" in data:
-        email_forecast += "Alerts:\n\n"
-        for alert in data["alerts"]:
-            start_date = get_date(alert["start"], lat=lat, long=long)
-            end_date = get_date(alert["end"], lat=lat, long=long)
-            email_forecast += f"Event: {alert['event']}\n"
-            email_forecast += f"From: {start_date} to {end_date}\n"
-            email_forecast += f"Details: {alert['description']}\n"
-            email_forecast += "---\n\n"
+    entries = data[spec['section']]
+    if report_type == 'current':
+        entries = [entries]
+        out.write(spec['title'].format(lat=lat, long=long, date=formatters['date'](entries[0]["dt"])))
+    else:
+        out.write(spec['title'].format(lat=lat, long=long))
 
-    return email_forecast
+    for entry in entries:
+        lines = [f"{prefix}{format_value(get(entry))}\n" for prefix, get, format_value in rows]
 
-# Function to parse current forcast output from Open Weather
-def generate_current_forecast(data, lat, long, unit='imperial'):
-    # Gather basic current weather details
-    current_weather = data["current"]
-    date = get_date(current_weather["dt"], lat=lat, long=long)
-    temp = convert_temperature(current_weather["temp"], unit)
-    feels_like = convert_temperature(current_weather["feels_like"], unit)
-    humidity = current_weather["humidity"]
-    wind_speed = convert_wind_speed(current_weather["wind_speed"], unit)
-    description = current_weather["weather"][0]["description"]
-
-    # Format the forecast in a readable email-style
-    email_forecast = (
-        f"Current Weather Forecast for {lat}, {long} on {date}:\n\n"
-        f"Temperature: {temp:.1f}°{'C' if unit == 'metric' else 'F'}\n"
-        f"Feels Like: {feels_like:.1f}°{'C' if unit == 'metric' else 'F'}\n"
-        f"Humidity: {humidity}%\n"
-        f"Weather: {description}\n"
-        f"Wind Speed: {wind_speed:.1f} {'km/h' if unit == 'metric' else 'mph'}\n"
-    )
-
-    if "rain" in current_weather and "1h" in current_weather["rain"]:
-        rain_mm = current_weather["rain"]["1h"]
-        if unit == 'imperial':
-            rain_inches = mm_to_inches(rain_mm)
-            email_forecast += f"Rain: {rain_inches:.2f} inches (last hour)\n"
-        else:
-            email_forecast += f"Rain: {rain_mm:.1f} mm (last hour)\n"
+        # Include rain data if present and properly extract the amount
+        rain_mm = get_rain(entry)
+        if rain_mm is not None:
+            lines.append(f"Rain: {format_rain(rain_mm)}{rain_line_end}")
 
-    email_forecast += "---\n\n"
+        lines.append("---\n\n")
+        out.write(''.join(lines))
 
     # Adding alerts to the forecast if they exist
     if "alerts" in data:
-        email_forecast += "Alerts:\n\n"
+        format_date = formatters[spec['alert_date']]
+        out.write("Alerts:\n\n")
         for alert in data["alerts"]:
-            start_date = get_date(alert["start"], lat=lat, long=long)
-            end_date = get_date(alert["end"], lat=lat, long=long)
-            email_forecast += f"Event: {alert['event']}\n"
-            email_forecast += f"From: {start_date} to {end_date}\n"
-            email_forecast += f"Details: {alert['description']}\n"
-            email_forecast += "---\n\n"
+            out.write(
+                f"Event: {alert['event']}\n"
+                f"From: {format_date(alert['start'])} to {format_date(alert['end'])}\n"
+                f"Details: {alert['description']}\n"
+                "---\n\n"
+            )
+
+# Function to render a forecast report into a string
+def generate_forecast(data, report_type, lat, long, unit='imperial'):
+    email_forecast = io.StringIO()
+    write_forecast(email_forecast, data, report_type, lat, long, unit)
+    return email_forecast.getvalue()
 
-    return email_forecast
+# Function to parse daily forcast output from Open Weather
+def generate_daily_forecast(data, lat, long, unit='imperial'):
+    return generate_forecast(data, 'daily', lat, long, unit)
+
+# Function to parse current forcast output from Open Weather
+def generate_current_forecast(data, lat, long, unit='imperial'):
+    return generate_forecast(data, 'current', lat, long, unit)
 
 # Function to parse hourly forcast output from Open Weather
 def generate_hourly_forecast(data, lat, long, unit='imperial'):
-    email_forecast = f"Hourly Weather Forecast for {lat}, {long}:\n\n"
-    
-    for hour in data["hourly"]:
-        date_time = get_date_time(hour["dt"], lat=lat, long=long)
-        temp = convert_temperature(hour["temp"], unit)
-        feels_like = convert_temperature(hour["feels_like"], unit)
-        humidity = hour["humidity"]
-        wind_speed = convert_wind_speed(hour["wind_speed"], unit)
-        description = hour["weather"][0]["description"]
-
-        email_forecast += (
-            f"Date & Time: {date_time}\n"
-            f"Temperature: {temp:.1f}°{'C' if unit == 'metric' else 'F'}\n"
-            f"Feels Like: {feels_like:.1f}°{'C' if unit == 'metric' else 'F'}\n"
-            f"Humidity: {humidity}%\n"
-            f"Weather: {description}\n"
-            f"Wind Speed: {wind_speed:.1f} {'km/h' if unit == 'metric' else 'mph'}\n"
+    return generate_forecast(data, 'hourly', lat, long, unit)
+
+# Compact Report Configuration
+compact_alert_chars = int(os.getenv('COMPACT_ALERT_CHARS', '160'))  # Alert details are cut to this many characters
+
+# Short forms of the Open Weather descriptions used in compact reports
+compact_descriptions = {
+    'clear sky': 'clr',
+    'few clouds': 'few cld',
+    'scattered clouds': 'sct cld',
+    'broken clouds': 'bkn cld',
+    'overcast clouds': 'ovc',
+    'light rain': 'lt rain',
+    'moderate rain': 'mod rain',
+    'heavy intensity rain': 'hvy rain',
+    'very heavy rain': 'vhvy rain',
+    'extreme rain': 'xtrm rain',
+    'freezing rain': 'frz rain',
+    'light intensity shower rain': 'lt shwr',
+    'shower rain': 'shwr',
+    'heavy intensity shower rain': 'hvy shwr',
+    'light intensity drizzle': 'lt drzl',
+    'drizzle': 'drzl',
+    'thunderstorm': 'tstm',
+    'thunderstorm with light rain': 'tstm lt rain',
+    'thunderstorm with rain': 'tstm rain',
+    'thunderstorm with heavy rain': 'tstm hvy rain',
+    'light snow': 'lt snow',
+    'heavy snow': 'hvy snow',
+    'light shower snow': 'lt snow shwr',
+    'shower snow': 'snow shwr',
+    'sleet': 'slt',
+    'mist': 'mist',
+    'fog': 'fog',
+    'haze': 'haze',
+}
+
+# Function to shorten a weather description for compact reports
+def compact_description(description):
+    return compact_descriptions.get(description, description)
+
+# Function to format rain for compact reports, empty when there was none
+def compact_rain(rain_mm, unit):
+    if not rain_mm:
+        return '-'
+    if unit == 'imperial':
+        return f"{mm_to_inches(rain_mm):.2f}".lstrip('0')
+    return f"{rain_mm:.1f}"
+
+# Function to build compact alert lines, repeated alerts are merged and details cut short
+def compact_alerts(data, timezone):
+    merged = {}
+    for alert in data.get("alerts", []):
+        details = ' '.join(alert['description'].split())
+        key = (alert['event'], details)
+        if key in merged:
+            merged[key][0] = min(merged[key][0], alert["start"])
+            merged[key][1] = max(merged[key][1], alert["end"])
+        else:
+            merged[key] = [alert["start"], alert["end"]]
+
+    lines = []
+    for (event, details), (start, end) in merged.items():
+        start_time = compact_time(start, timezone)
+        end_time = compact_time(end, timezone)
+        if end_time[:5] == start_time[:5]:
+            end_time = end_time[6:]  # Same day, only show the end time
+        if len(details) > compact_alert_chars:
+            details = details[:compact_alert_chars - 3].rstrip() + '...'
+        lines.append(f"! {event} {start_time}-{end_time}: {details}")
+    return lines
+
+# Function to format a timestamp as a short local day and time, eg "Fri01 14:00"
+def compact_time(timestamp, timezone):
+    local_time = datetime.utcfromtimestamp(timestamp).replace(tzinfo=pytz.utc).astimezone(timezone)
+    return local_time.strftime('%a%d %H:%M')
+
+# Function to render a compact report as a tabular, low bandwidth alternative to the generate_*_forecast functions
+def generate_compact_forecast(data, report_type, lat, long, unit='imperial', byte_budget=None):
+    timezone = get_timezone(lat, long)
+    temp_unit = 'C' if unit == 'metric' else 'F'
+    wind_unit = 'kmh' if unit == 'metric' else 'mph'
+    rain_unit = 'mm' if unit == 'metric' else 'in'
+    header = []
+    rows = []
+
+    if report_type == 'current':
+        current_weather = data["current"]
+        rain_mm = current_weather.get("rain", {}).get("1h")
+        header.append(f"NOW {lat},{long} {compact_time(current_weather['dt'], timezone)}")
+        rows.append(
+            f"T{convert_temperature(current_weather['temp'], unit):.0f}{temp_unit} "
+            f"FL{convert_temperature(current_weather['feels_like'], unit):.0f} "
+            f"H{current_weather['humidity']}% "
+            f"W{convert_wind_speed(current_weather['wind_speed'], unit):.0f}{wind_unit} "
+            f"{compact_description(current_weather['weather'][0]['description'])} "
+            f"R{compact_rain(rain_mm, unit)}{rain_unit if rain_mm else ''}"
         )
 
-        # Include rain data if present and properly extract the amount
-        if "rain" in hour and "1h" in hour["rain"]:
-            rain_mm = hour["rain"]["1h"]
-            if unit == 'imperial':
-                rain_inches = mm_to_inches(rain_mm)
-                email_forecast += f"Rain: {rain_inches:.2f} inches\n"
-            else:
-                email_forecast += f"Rain: {rain_mm:.1f} mm\n"
-                
-        email_forecast += "---\n\n"
+    elif report_type == 'hourly':
+        header.append(f"HOURLY {lat},{long} {temp_unit} {wind_unit} {rain_unit}")
+        header.append("HH T FL H% W WX RAIN")
+        current_day = None
+        for hour in data["hourly"]:
+            local_time = datetime.utcfromtimestamp(hour["dt"]).replace(tzinfo=pytz.utc).astimezone(timezone)
+            day = local_time.strftime('%a%d')
+            if day != current_day:
+                rows.append(f"{day}:")
+                current_day = day
+            rows.append(
+                f"{local_time.strftime('%H')} "
+                f"{convert_temperature(hour['temp'], unit):.0f} "
+                f"{convert_temperature(hour['feels_like'], unit):.0f} "
+                f"{hour['humidity']} "
+                f"{convert_wind_speed(hour['wind_speed'], unit):.0f} "
+                f"{compact_description(hour['weather'][0]['description'])} "
+                f"{compact_rain(hour.get('rain', {}).get('1h'), unit)}"
+            )
 
-    if "alerts" in data:
-        email_forecast += "Alerts:\n\n"
-        for alert in data["alerts"]:
-            start_date = get_date_time(alert["start"], lat=lat, long=long)
-            end_date = get_date_time(alert["end"], lat=lat, long=long)
-            email_forecast += f"Event: {alert['event']}\n"
-            email_forecast += f"From: {start_date} to {end_date}\n"
-            email_forecast += f"Details: {alert['description']}\n"
-            email_forecast += "---\n\n"
-
-    return email_forecast
\ No newline at end of file
+    elif report_type == 'daily':
+        header.append(f"DAILY {lat},{long} {temp_unit} {wind_unit} {rain_unit}")
+        header.append("DAY HI/LO H% W WX RAIN")
+        for day in data["daily"]:
+            local_time = datetime.utcfromtimestamp(day["dt"]).replace(tzinfo=pytz.utc).astimezone(timezone)
+            rows.append(
+                f"{local_time.strftime('%a%d')} "
+                f"{convert_temperature(day['temp']['max'], unit):.0f}/{convert_temperature(day['temp']['min'], unit):.0f} "
+                f"{day['humidity']} "
+                f"{convert_wind_speed(day['wind_speed'], unit):.0f} "
+                f"{compact_description(day['weather'][0]['description'])} "
+                f"{compact_rain(day.get('rain'), unit)}"
+            )
+
+    else:
+        raise ValueError(f"Unknown report type: {report_type}")
+
+    return fit_compact_report(header, rows, compact_alerts(data, timezone), byte_budget)
+
+# Function to join the compact report, dropping alert details and then rows from the end to fit the byte budget
+def fit_compact_report(header, rows, alerts, byte_budget=None):
+    def render(rows, alerts, note=None):
+        lines = header + rows + ([note] if note else []) + alerts
+        return '\n'.join(lines) + '\n'
+
+    email_forecast = render(rows, alerts)
+    if byte_budget is None or len(email_forecast.encode('utf-8')) <= byte_budget:
+        return email_forecast
+
+    # Keep the alert events but drop their details first, they are the least compact part
+    short_alerts = [alert.split(': ', 1)[0] for alert in alerts]
+    email_forecast = render(rows, short_alerts)
+    kept = len(rows)
+    while kept > 0 and len(email_forecast.encode('utf-8')) > byte_budget:
+        kept -= 1
+        email_forecast = render(rows[:kept], short_alerts, f"+{len(rows) - kept} more")
+
+    # Still too large, cut it at the budget without splitting a character
+    return email_forecast.encode('utf-8')[:byte_budget].decode('utf-8', 'ignore')
@@ -0,0 +1,103 @@
+import contextvars
+import queue
+import threading
+import time
+import zlib
+from contextlib import nullcontext
+from .logger import logger
+from modules import metrics
+
+# Staged request pipeline: the caller submits requests, a pool of workers builds the replies and one sender
+# thread delivers them. Requests with the same key always go to the same worker so they stay in order.
+# A sender that returns False leaves the request unsent, the same as one that raises, and so does a handler that
+# raises. A handler that returns None means no reply is intended and the request counts as done. Each request keeps the
+# context it was submitted from, so its correlation ID follows it through the workers and the sender.
+class Pipeline:
+    def __init__(self, handler, sender, workers=4, queue_size=20, sender_context=None, sender_idle=5):
+        self.handler = handler
+        self.sender = sender
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.sender_context = sender_context or nullcontext
+        self.sender_idle = sender_idle
+        self.worker_queues = []
+        self.send_queue = queue.Queue(maxsize=queue_size)
+        self.results = []
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.started = False
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        with self.start_lock:
+            if self.started:
+                return
+            for index in range(self.workers):
+                worker_queue = queue.Queue(maxsize=self.queue_size)
+                self.worker_queues.append(worker_queue)
+                threading.Thread(target=self.run_worker, args=(worker_queue,), name=f"pipeline-worker-{index}", daemon=True).start()
+            threading.Thread(target=self.run_sender, name="pipeline-sender", daemon=True).start()
+            self.started = True
+
+    # Queue a request, blocks while the worker for this key is full so ingest slows down to match
+    def submit(self, key, item_id, payload):
+        self.start()
+        with self.condition:
+            self.in_flight += 1
+            metrics.set_gauge('winlink_pipeline_in_flight', self.in_flight)
+        worker_queue = self.worker_queues[zlib.crc32(key.lower().encode('utf-8')) % self.workers]
+        worker_queue.put((item_id, payload, contextvars.copy_context(), time.perf_counter()))
+
+    def run_worker(self, worker_queue):
+        while True:
+            item_id, payload, context, submitted = worker_queue.get()
+            failed = False
+            try:
+                reply = context.run(self.handle, payload)
+            except Exception as e:
+                context.run(logger.error, f"Failed to handle request {item_id}: {str(e)}")
+                reply, failed = None, True
+            self.send_queue.put((item_id, reply, failed, context, submitted))
+
+    def handle(self, payload):
+        with metrics.stage('handle'):
+            return self.handler(payload)
+
+    # Deliver replies in the order they were built, keeping the sender context open while replies keep coming
+    def run_sender(self):
+        while True:
+            item = self.send_queue.get()
+            with self.sender_context():
+                while item is not None:
+                    item_id, reply, failed, context, submitted = item
+                    context.run(self.deliver, item_id, reply, submitted, failed)
+                    try:
+                        item = self.send_queue.get(timeout=self.sender_idle)
+                    except queue.Empty:
+                        item = None
+
+    def deliver(self, item_id, reply, submitted, failed=False):
+        sent = not failed
+        if reply is not None:
+            try:
+                with metrics.stage('send'):
+                    sent = self.sender(reply) is not False
+            except Exception as e:
+                logger.error(f"Failed to send reply for request {item_id}: {str(e)}")
+                sent = False
+        metrics.observe('winlink_stage_duration_seconds', time.perf_counter() - submitted, stage='request')
+        outcome = 'handler_error' if failed else 'no_reply' if reply is None else 'sent' if sent else 'not_sent'
+        metrics.inc('winlink_replies_total', outcome=outcome)
+        with self.condition:
+            self.results.append((item_id, sent))
+            self.in_flight -= 1
+            metrics.set_gauge('winlink_pipeline_in_flight', self.in_flight)
+            self.condition.notify_all()
+
+    # Get the requests finished since the last call as (item_id, sent), optionally waiting for all in flight
+    def completed(self, wait=False):
+        with self.condition:
+            if wait:
+                self.condition.wait_for(lambda: self.in_flight == 0)
+            results, self.results = self.results, []
+        return results
@@ -0,0 +1,128 @@
+import math
+import os
+import threading
+import time
+import requests
+from .logger import logger
+from modules import forecastCache
+from modules import metrics
+from modules import upstream
+
+# Prefetch Configuration
+prefetch_top_k = int(os.getenv('PREFETCH_TOP_K', '20'))  # Hottest grid cells kept fresh, 0 disables the refresher
+prefetch_budget = int(os.getenv('PREFETCH_BUDGET', '30'))  # Most Open Weather calls the refresher makes per hour
+prefetch_min_requests = float(os.getenv('PREFETCH_MIN_REQUESTS', '3'))  # Decayed request count before a cell counts as hot
+prefetch_half_life = float(os.getenv('PREFETCH_HALF_LIFE', '3600'))  # Seconds for a cell's request count to halve
+prefetch_lead = int(os.getenv('PREFETCH_LEAD', '120'))  # Seconds before expiry that a hot cell is fetched again
+prefetch_interval = int(os.getenv('PREFETCH_INTERVAL', '30'))
+
+# Requests per grid cell: cell -> {'score': decayed request count, 'updated': time, 'ttl': shortest TTL asked for}
+_demand = {}
+# Times of the refresher's calls in the last hour, the budget window
+_spent = []
+_lock = threading.Lock()
+
+# Function to decay a cell's request count to a point in time
+def decayed(entry, now):
+    return entry['score'] * math.pow(0.5, (now - entry['updated']) / prefetch_half_life)
+
+# Function to count a request for a location, called with the coordinates each request resolved to
+def record_request(lat, long, report_type, now=None):
+    now = now if now is not None else time.time()
+    cell = forecastCache.grid_cell(lat, long)
+    ttl = forecastCache.forecast_ttl[report_type]
+    with _lock:
+        entry = _demand.get(cell)
+        if entry is None:
+            _demand[cell] = {'score': 1.0, 'updated': now, 'ttl': ttl}
+            return
+        entry['score'] = decayed(entry, now) + 1
+        entry['updated'] = now
+        entry['ttl'] = min(entry['ttl'], ttl)
+
+# Function to get the hottest cells, highest request count first, as (cell, score, ttl)
+def hotspots(now=None, limit=prefetch_top_k):
+    now = now if now is not None else time.time()
+    with _lock:
+        # Forget cells that have cooled down to nothing so the table stays small
+        for cell in [cell for cell, entry in _demand.items() if decayed(entry, now) < 0.01]:
+            del _demand[cell]
+        ranked = sorted(((cell, decayed(entry, now), entry['ttl']) for cell, entry in _demand.items()), key=lambda hot: -hot[1])
+    return [hot for hot in ranked if hot[1] >= prefetch_min_requests][:limit]
+
+# Function to take one call from the hourly budget, returns False once it is spent
+def spend_budget(now):
+    with _lock:
+        _spent[:] = [spent for spent in _spent if now - spent < 3600]
+        if len(_spent) >= prefetch_budget:
+            return False
+        _spent.append(now)
+        return True
+
+# Function to fetch the hot cells whose cached forecast is about to expire, returns the number fetched
+def refresh_hotspots(weather_api_key, now=None):
+    now = now if now is not None else time.time()
+    hot = hotspots(now)
+    metrics.clear('winlink_hotspot_requests')
+    for cell, score, ttl in hot:
+        metrics.set_gauge('winlink_hotspot_requests', round(score, 2), cell=f"{cell[0]},{cell[1]}")
+
+    refreshed = over_budget = 0
+    for cell, score, ttl in hot:
+        entry = forecastCache.saved_entry(cell)
+        if entry is not None and now - entry['fetched'] < ttl - prefetch_lead:
+            continue
+        if not spend_budget(now):
+            metrics.inc('winlink_prefetch_total', outcome='over_budget')
+            over_budget += 1
+            continue
+        try:
+            with upstream.priority(upstream.background_priority):
+                data = forecastCache.fetch_onecall(cell[0], cell[1], weather_api_key)
+        except upstream.CircuitOpenError as e:
+            metrics.inc('winlink_prefetch_total', outcome='error')
+            logger.warning(f"Stopping prefetch, {str(e)}")
+            break
+        except requests.RequestException as e:
+            metrics.inc('winlink_prefetch_total', outcome='error')
+            logger.error(f"Failed to prefetch the forecast for cell {cell}: {str(e)}")
+            continue
+        if data is None:
+            metrics.inc('winlink_prefetch_total', outcome='error')
+            continue
+        forecastCache.store_forecast(cell, data, prefetched=True)
+        metrics.inc('winlink_prefetch_total', outcome='refreshed')
+        refreshed += 1
+    if refreshed or over_budget:
+        logger.info(f"Prefetched the forecast for {refreshed} of {len(hot)} hot grid cells, {over_budget} left to expire "
+                    f"by the budget of {prefetch_budget} calls per hour")
+    return refreshed
+
+# Function to keep the hottest cells fresh in the background
+def run_refresher(weather_api_key, interval=prefetch_interval):
+    while True:
+        try:
+            refresh_hotspots(weather_api_key)
+        except Exception as e:
+            logger.error(f"Error prefetching forecasts: {str(e)}")
+        time.sleep(interval)
+
+# Function to start the refresher thread, unless it is disabled
+def start_refresher(weather_api_key, interval=prefetch_interval):
+    if prefetch_top_k <= 0 or prefetch_budget <= 0:
+        return None
+    thread = threading.Thread(target=run_refresher, args=(weather_api_key, interval), name="forecast-prefetch", daemon=True)
+    thread.start()
+    return thread
+
+# Function to format the hotspot table for the admin endpoint
+def hotspot_table():
+    lines = [f"{'cell':>16}  {'requests':>8}  {'ttl':>5}  {'age':>6}"]
+    now = time.time()
+    for cell, score, ttl in hotspots(now):
+        entry = forecastCache.saved_entry(cell)
+        age = f"{now - entry['fetched']:.0f}" if entry is not None else '-'
+        lines.append(f"{cell[0]:>7},{cell[1]:>8}  {score:8.2f}  {ttl:5d}  {age:>6}")
+    return '\n'.join(lines) + '\n'
+
+metrics.add_admin_route('/debug/hotspots', lambda: (200, 'text/plain; charset=utf-8', hotspot_table()))
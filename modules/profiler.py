@@ -0,0 +1,141 @@
+import cProfile
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from .logger import logger
+from modules import db
+from modules import metrics
+
+# Profiler Configuration
+profile_cycles = int(os.getenv('PROFILE_CYCLES', '5'))  # fetch_emails cycles profiled per trigger
+profile_dir = os.getenv('PROFILE_DIR', os.path.dirname(db.db_path) or '.')
+sample_interval = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))  # Seconds between stack samples of all threads
+
+# Nothing is recorded until a trigger sets the number of cycles left, the check in cycle() is all it costs otherwise
+_pending = 0
+_session = None
+_lock = threading.Lock()
+
+# Function to name an output file in the profile directory
+def output_path(prefix, extension):
+    os.makedirs(profile_dir, exist_ok=True)
+    return os.path.join(profile_dir, f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.{extension}")
+
+# Function to format the stack of every thread, returns the text
+def thread_stacks():
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    sections = []
+    for ident, frame in sys._current_frames().items():
+        sections.append(f"Thread {names.get(ident, 'unknown')} ({ident}):\n" + ''.join(traceback.format_stack(frame)))
+    return '\n'.join(sections)
+
+# Function to write the stack of every thread to the profile directory, returns the file path
+def dump_threads():
+    path = output_path('threads', 'txt')
+    with open(path, 'w') as file:
+        file.write(thread_stacks())
+    logger.info(f"Thread stacks written to {path}")
+    return path
+
+# Function to fold a frame and its callers into one collapsed stack line, root first
+def collapse(thread_name, frame):
+    names = []
+    while frame is not None:
+        names.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ';'.join([thread_name] + names[::-1])
+
+# Samples the stacks of every thread while a profiled cycle runs, cProfile only sees the fetch thread
+class StackSampler:
+    def __init__(self, counts, interval=sample_interval):
+        self.counts = counts
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    stack = collapse(names.get(ident, 'unknown'), frame)
+                    self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+# Function to arm the profiler for a number of fetch_emails cycles and dump the thread stacks right away
+def trigger(cycles=profile_cycles):
+    global _pending
+    with _lock:
+        already = _pending > 0
+        _pending = max(_pending, cycles)
+    logger.info(f"Profiling {'already running, extended to' if already else 'the next'} {cycles} fetch cycles")
+    return dump_threads()
+
+# Function to write the profile of the finished session, pstats for the fetch thread and collapsed stacks for all threads
+def write_session(session):
+    stats_path = output_path('profile', 'pstats')
+    session['profile'].dump_stats(stats_path)
+    stacks_path = output_path('profile', 'collapsed')
+    with open(stacks_path, 'w') as file:
+        for stack, count in sorted(session['stacks'].items()):
+            file.write(f"{stack} {count}\n")
+    logger.info(f"Profile of {session['cycles']} fetch cycles written to {stats_path} and {stacks_path}")
+
+# Profile one fetch_emails cycle if the profiler is armed
+@contextmanager
+def cycle():
+    global _pending, _session
+    if not _pending:
+        yield
+        return
+
+    with _lock:
+        if _session is None:
+            _session = {'profile': cProfile.Profile(), 'stacks': {}, 'cycles': 0}
+        session = _session
+    sampler = StackSampler(session['stacks'])
+    sampler.start()
+    session['profile'].enable()
+    try:
+        yield
+    finally:
+        session['profile'].disable()
+        sampler.stop()
+        with _lock:
+            session['cycles'] += 1
+            _pending -= 1
+            finished = _pending <= 0
+            if finished:
+                _pending = 0
+                _session = None
+        if finished:
+            try:
+                write_session(session)
+            except OSError as e:
+                logger.error(f"Could not write the profile: {str(e)}")
+
+# Function to trigger the profiler on SIGUSR1, must be called from the main thread
+def install_signal_handler():
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    # Files are written from a new thread, the handler interrupts whatever the main thread was doing
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=trigger, name="profile-trigger", daemon=True).start())
+
+# Admin routes on the metrics endpoint
+def profile_route():
+    path = trigger()
+    return 200, 'text/plain; charset=utf-8', f"Profiling the next {profile_cycles} fetch cycles, thread stacks written to {path}\n"
+
+metrics.add_admin_route('/debug/profile', profile_route)
+metrics.add_admin_route('/debug/threads', lambda: (200, 'text/plain; charset=utf-8', thread_stacks()))
@@ -1,20 +1,38 @@
 import os
 import imaplib
 import email
+import uuid
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import smtplib
 from modules import gptWeather
+from modules import connections
+from modules import imapHelper
+from modules import pipeline
 from modules import db
-from .logger import logger
+from modules import upstream
+from modules import metrics
+from modules import subscriptions
+from .logger import logger, correlation
 import time
 
 # SMTP Configuration
 imap_host = os.getenv('IMAP_HOST', 'imap.gmail.com')
+imap_port = int(os.getenv('IMAP_PORT', '993'))
+imap_ssl = os.getenv('IMAP_SSL', 'true').lower() == 'true'
 smtp_host = os.getenv('SMTP_HOST', 'smtp.gmail.com')
+smtp_port = int(os.getenv('SMTP_PORT', '587'))
+smtp_starttls = os.getenv('SMTP_STARTTLS', 'true').lower() == 'true'
 smtp_username = os.getenv('SMTP_USERNAME')
 smtp_password = os.getenv('SMTP_PASSWORD')
 mail_rate_limit = int(os.getenv('RATE_LIMIT', '30'))
+imap_fetch_batch = int(os.getenv('IMAP_FETCH_BATCH', '50'))
+imap_body_max_bytes = int(os.getenv('IMAP_BODY_MAX_BYTES', '16384'))
+pipeline_workers = int(os.getenv('WORKERS', '4'))
+pipeline_queue_size = int(os.getenv('QUEUE_SIZE', '20'))
+request_max_attempts = int(os.getenv('REQUEST_MAX_ATTEMPTS', '3'))  # Failed attempts before an email gets the error reply
+
+# Only these headers are downloaded before deciding whether to fetch the body
+header_fields = 'FROM SUBJECT MESSAGE-ID'
 
 # Handling allowed_domains as a list
 allowed_domains_string = os.getenv('ALLOWED_DOMAINS')
@@ -28,118 +46,402 @@ oai_max_tokens = int(os.getenv('OAI_MAX_TOKENS', '50'))
 # Open Weather Map Configuration
 weather_api_key = os.getenv('WEATHER_API_KEY')
 
-def move_to_label(mail, mail_id, folder_name):
+# Claim key (Message-ID) per UID for the emails this instance is handling, until they are moved or released
+claimed_messages = {}
+
+# Set when the last fetch left emails unread to retry, eg deferred while a circuit was open or a reply failed to send
+retry_pending = False
+
+# Shared SMTP connection for sending replies
+smtp_connection = connections.SmtpConnection(smtp_host, smtp_port, smtp_username, smtp_password, starttls=smtp_starttls)
+
+# Move a set of emails by UID, using UID MOVE (RFC 6851) when the server supports it
+# Returns 'moved', 'copied' when the originals are left to expunge, or None if the server refused
+def move_to_label(mail, uids, folder_name):
+    message_set = imapHelper.uid_set(uids)
+    if 'MOVE' in mail.capabilities:
+        result, data = mail.uid('MOVE', message_set, folder_name)
+        if result != 'OK':
+            logger.error(f"Failed to move mail UIDs {message_set} to {folder_name}: {data}")
+            return None
+        logger.info(f"Moved mail UIDs {message_set} to {folder_name}.")
+        return 'moved'
+
     # Moving emails in standard IMAP (MXroute does not support Gmail labels)
-    result, _ = mail.copy(mail_id, folder_name)  # Copy to another folder
-    if result == 'OK':
-        mail.store(mail_id, '+FLAGS', '\\Deleted')  # Mark the original email as deleted
-        mail.expunge()  # Permanently remove email marked as deleted
-    logger.info(f"Moved mail ID {mail_id} to {folder_name}.")
+    result, data = mail.uid('COPY', message_set, folder_name)  # Copy to another folder
+    if result != 'OK':
+        logger.error(f"Failed to copy mail UIDs {message_set} to {folder_name}: {data}")
+        return None
+    mail.uid('STORE', message_set, '+FLAGS', '(\\Deleted)')  # Mark the original emails as deleted
+    logger.info(f"Moved mail UIDs {message_set} to {folder_name}.")
+    return 'copied'  # Caller expunges once for the whole batch
+
+# Helper to decode a text part with its declared charset
+def decode_part(part):
+    payload = part.get_payload(decode=True)
+    if not payload:
+        return None
+    try:
+        return payload.decode(part.get_content_charset() or 'utf-8', 'replace')
+    except LookupError:
+        return payload.decode('utf-8', 'replace')
 
 # Helper to extract email body
 def extract_body(message):
     if message.is_multipart():
         for part in message.walk():
             if part.get_content_type() == 'text/plain':
-                return part.get_payload(decode=True).decode('utf-8')
+                return decode_part(part)
     else:
-        return message.get_payload(decode=True).decode('utf-8')
+        return decode_part(message)
     return None
 
-# Get emails with subject weather that are unread and parse data
-def fetch_emails():
+# Open an authenticated IMAP session on the inbox
+def connect_imap():
+    mail = imaplib.IMAP4_SSL(imap_host, imap_port) if imap_ssl else imaplib.IMAP4(imap_host, imap_port)
+    mail.login(smtp_username, smtp_password)
+
+    # Servers such as Gmail and Dovecot only list some capabilities (eg MOVE) once logged in
+    status, data = mail.capability()
+    if status == 'OK' and data and data[0]:
+        mail.capabilities = tuple(data[0].decode('ascii', 'replace').upper().split())
+    mail.select('Inbox')
+    return mail
+
+# Get emails with subject weather that are unread and parse data, reusing the session if one is passed in
+def fetch_emails(mail=None):
+    global retry_pending
     logger.info("Starting email fetch process...")
+    retry_pending = False
     try:
-        with imaplib.IMAP4_SSL(imap_host) as mail:
-            mail.login(smtp_username, smtp_password)
-            mail.select('Inbox')
-
-            while True:
-                status, messages = mail.search(None, '(SUBJECT "weather" UNSEEN)')
-                if status != 'OK' or not messages[0]:
-                    logger.info("No new unread emails matching the criteria, or failed to search.")
-                    break
-
-                # Process only the first email in the list to maintain sequential processing
-                first_email_id = messages[0].split()[0]
-                logger.info(f"Processing email ID: {first_email_id}")
-
-                status, data = mail.fetch(first_email_id, '(RFC822)')
-                if status != 'OK':
-                    logger.error(f"Failed to fetch email with ID {first_email_id}.")
-                    continue
-
-                email_message = None
-                for response_part in data:
-                    if isinstance(response_part, tuple):
-                        email_message = email.message_from_bytes(response_part[1])
-                        break
-
-                if email_message:
-                    from_field = email_message['from']
-                    domain = from_field.split('@')[-1].strip('>')
-                    logger.info(f"Email from: {from_field}")
-                    logger.info(f"Domain extracted: {domain}")
-
-                    if '*' in allowed_domains or domain in allowed_domains:
-                        logger.info("Handling email from allowed domain...")
-                        handle_email(email_message)
-                        move_to_label(mail, first_email_id, 'Processed')
-                    else:
-                        logger.warning(f"Domain {domain} not in allowed list.")
-                        move_to_label(mail, first_email_id, 'NoAction')
-
-    except imaplib.IMAPError as e:
+        if mail is not None:
+            return process_mailbox(mail)
+        with connect_imap() as mail:
+            return process_mailbox(mail)
+
+    except imaplib.IMAP4.error as e:
         logger.error(f"IMAP error occurred: {e}")
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
     finally:
         logger.info("Email fetch process completed.")
+    return None
+
+# Search the inbox once and process everything found in UID batches, returns the number of emails found
+def process_mailbox(mail):
+    with metrics.stage('imap_search'):
+        status, messages = mail.uid('SEARCH', None, '(SUBJECT "weather" UNSEEN)')
+    if status != 'OK' or not messages[0]:
+        logger.info("No new unread emails matching the criteria, or failed to search.")
+        return 0
+
+    uids = messages[0].split()
+    logger.info(f"Found {len(uids)} new emails to process.")
+    for start in range(0, len(uids), imap_fetch_batch):
+        process_batch(mail, uids[start:start + imap_fetch_batch])
+        move_emails(mail, {'Processed': completed_uids()})
+
+    # Wait for the replies still in the pipeline, emails only move to Processed once their reply was sent
+    move_emails(mail, {'Processed': completed_uids(wait=True)})
+    return len(uids)
+
+# Get the UIDs whose reply has been sent, failed replies stay unread in the inbox to be retried by any instance
+def completed_uids(wait=False):
+    global retry_pending
+    uids = []
+    for uid, sent in request_pipeline.completed(wait=wait):
+        if sent:
+            uids.append(uid)
+        else:
+            logger.warning(f"Reply for mail UID {uid} was not sent, leaving it in the inbox.")
+            retry_pending = True
+            db.release_claims([claimed_messages.pop(uid)])
+    return uids
+
+# Move emails to their folders in grouped UID sets and expunge once if needed
+def move_emails(mail, moves):
+    if not any(moves.values()):
+        return
+    moved_uids = []
+    with metrics.stage('imap_move'):
+        needs_expunge = False
+        for folder_name, folder_uids in moves.items():
+            if not folder_uids:
+                continue
+            result = move_to_label(mail, folder_uids, folder_name)
+            if result is not None:
+                moved_uids.extend(folder_uids)
+            needs_expunge = needs_expunge or result == 'copied'
+        if needs_expunge:
+            mail.expunge()  # Permanently remove the moved emails, once per batch
+    keys = [claimed_messages.pop(uid) for uid in moved_uids if uid in claimed_messages]
+    db.record_stages(keys, 'moved')
+    db.finish_claims(keys)
+
+    # Emails the server would not move stay unread in the inbox, released so the next cycle on any instance moves them
+    db.release_claims([claimed_messages.pop(uid) for folder_uids in moves.values() for uid in folder_uids if uid in claimed_messages])
+
+# Function to get the key an email is claimed by, the Message-ID (or else the UID) is the same for every instance
+def claim_key(email_message, uid):
+    message_id = (email_message['message-id'] or '').strip()
+    return message_id or f"uid:{uid}"
+
+# Fetch the headers and structure of a batch of emails, then only the text body of the ones that pass the checks
+def process_batch(mail, uids):
+    global retry_pending
+    with metrics.stage('imap_fetch_headers'):
+        status, data = mail.uid('FETCH', imapHelper.uid_set(uids), f"(BODY.PEEK[HEADER.FIELDS ({header_fields})] BODYSTRUCTURE)")
+    if status != 'OK':
+        logger.error(f"Failed to fetch emails with UIDs {imapHelper.uid_set(uids)}.")
+        return
+
+    messages = []
+    for fetched in sorted(imapHelper.parse_fetch_response(data), key=lambda fetched: fetched.get('UID', 0)):
+        uid = fetched.get('UID')
+        headers = imapHelper.fetched_section(fetched, 'BODY[HEADER')
+        if uid is not None and headers is not None:
+            messages.append((uid, fetched, email.message_from_bytes(headers)))
+
+    # Claim the batch so an email is only handled by one instance, even when several read the same mailbox
+    keys = {uid: claim_key(email_message, uid) for uid, _, email_message in messages}
+    claimed = db.claim_messages(list(keys.values()))
+
+    moves = {'Processed': [], 'NoAction': []}
+    accepted = []
+    request_ids = {}
+    for uid, fetched, email_message in messages:
+        if keys[uid] not in claimed:
+            logger.info(f"Email UID {uid} is claimed by another instance, skipping it.")
+            metrics.inc('winlink_emails_total', outcome='claimed_elsewhere')
+            continue
+        claimed_messages[uid] = keys[uid]
+
+        # Every log line about this request carries the same correlation ID
+        request_ids[uid] = uuid.uuid4().hex[:12]
+        with correlation(request_ids[uid]):
+            logger.info(f"Processing email UID: {uid}, Message-ID: {email_message['message-id']}")
+            from_field = email_message['from']
+            domain = from_field.split('@')[-1].strip('>')
+            logger.info(f"Email from: {from_field}")
+            logger.info(f"Domain extracted: {domain}")
+
+            # An email seen before a restart resumes from its journal, a reply that may have gone out is never sent again
+            journal = db.get_journal(keys[uid])
+            if db.stage_reached(journal, 'sending'):
+                logger.info(f"Reply for email UID {uid} was already sent, moving it.")
+                metrics.inc('winlink_emails_total', outcome='already_sent')
+                moves['Processed'].append(uid)
+            elif journal is not None:
+                logger.info(f"Resuming email UID {uid} after the {journal['stage']} stage.")
+                accepted.append((uid, email_message, imapHelper.find_text_part(fetched.get('BODYSTRUCTURE'))))
+            elif not ('*' in allowed_domains or domain in allowed_domains):
+                logger.warning(f"Domain {domain} not in allowed list.")
+                metrics.inc('winlink_emails_total', outcome='no_action')
+                moves['NoAction'].append(uid)
+            elif is_rate_limited(from_field):
+                metrics.inc('winlink_emails_total', outcome='rate_limited')
+                moves['Processed'].append(uid)
+            else:
+                db.record_stage(keys[uid], 'received')
+                accepted.append((uid, email_message, imapHelper.find_text_part(fetched.get('BODYSTRUCTURE'))))
+
+    # Only download the text/plain part of the accepted emails, capped in size
+    bodies, unfetched = fetch_text_bodies(mail, accepted)
+    if unfetched:
+        # A failed fetch is usually a temporary server error, the emails stay unread and released for the next cycle
+        logger.warning(f"Leaving mail UIDs {imapHelper.uid_set(unfetched)} in the inbox, their body could not be fetched.")
+        db.release_claims([claimed_messages.pop(uid) for uid in unfetched])
+        retry_pending = True
+        accepted = [request for request in accepted if request[0] not in unfetched]
+    for uid, email_message, text_part in accepted:
+        if uid in bodies:
+            _, encoding, charset = text_part
+            email_message.set_type('text/plain')
+            email_message.set_param('charset', charset)
+            email_message['Content-Transfer-Encoding'] = encoding
+            # Surrogate escapes keep the raw bytes of an 8bit body, get_payload(decode=True) gives them back unchanged
+            email_message.set_payload(bodies[uid].decode('ascii', 'surrogateescape'))
 
-# Determine report type and send to handle_weather_report
-def handle_email(message):
-    from_field = message['from']
+    # Start geocoding the whole batch now so locations that need Open AI share batched requests, each one
+    # with the upstream priority of the report it is for
+    for _, email_message, _ in accepted:
+        with upstream.priority(subject_report_type(email_message['subject'])):
+            gptWeather.prefetch_locations([(extract_body(email_message) or '').strip()], oai_api_key, oai_model=oai_model, oai_max_tokens=oai_max_tokens)
+    gptWeather.flush_locations(oai_api_key, oai_model=oai_model, oai_max_tokens=oai_max_tokens)
+
+    for uid, email_message, text_part in accepted:
+        with correlation(request_ids[uid]):
+            logger.info("Handling email from allowed domain...")
+            request = {'key': keys[uid], 'message': email_message}
+            request_pipeline.submit(email_message['from'], uid, request)  # Blocks while the pipeline is full
+
+    move_emails(mail, moves)
+
+# Function to get the report type asked for in the subject, eg "current" for "weather:current:compact"
+def subject_report_type(subject):
+    options = (subject or '').split(':')
+    return options[1].strip().lower() if len(options) > 1 else ''
+
+# Fetch the text/plain part of each email, one UID FETCH per distinct part number
+# Returns the bodies by UID and the UIDs whose FETCH failed
+def fetch_text_bodies(mail, accepted):
+    uids_by_part = {}
+    for uid, _, text_part in accepted:
+        if text_part is not None:
+            uids_by_part.setdefault(text_part[0], []).append(uid)
+
+    bodies = {}
+    unfetched = []
+    for part_number, part_uids in uids_by_part.items():
+        with metrics.stage('imap_fetch_body'):
+            status, data = mail.uid('FETCH', imapHelper.uid_set(part_uids), f"(BODY.PEEK[{part_number}]<0.{imap_body_max_bytes}>)")
+        if status != 'OK':
+            logger.error(f"Failed to fetch body part {part_number} for UIDs {imapHelper.uid_set(part_uids)}.")
+            unfetched.extend(part_uids)
+            continue
+        for fetched in imapHelper.parse_fetch_response(data):
+            body = imapHelper.fetched_section(fetched, f"BODY[{part_number}]")
+            if fetched.get('UID') in part_uids and body is not None:
+                bodies[fetched['UID']] = body
+    return bodies, unfetched
+
+# Check and record the last request time of the sender, discarding requests that come too often
+def is_rate_limited(from_field):
     current_time = time.time()
-    last_request_time = db.get_last_request_time(from_field)
 
-    # Check if the last request was less than 30 seconds ago
-    if last_request_time is not None and (current_time - last_request_time < mail_rate_limit):
+    # Check and update the last request time in one step, shared by every instance using the database
+    if not db.record_request_time(from_field, current_time, mail_rate_limit):
         logger.warning(f"Discarding request from {from_field} due to high frequency.")
-        return  # Skip processing this request
+        return True  # Skip processing this request
+    return False
+
+# Build the reply for a queued request, a reply rendered before a restart is sent as it was
+def handle_request(request):
+    journal = db.get_journal(request['key'])
+    if db.stage_reached(journal, 'rendered'):
+        logger.info("Using the reply rendered before the restart.")
+        return journal['data']['reply']
 
-    # Update the last request time in the database
-    db.update_last_request_time(from_field, current_time)
+    try:
+        reply = handle_email(request['message'], journal_key=request['key'])
+    except Exception as e:
+        # The email stays unread to be retried, until it has failed too often and gets the error reply instead
+        attempts = (journal['data'].get('attempts', 0) if journal else 0) + 1
+        db.record_stage(request['key'], journal['stage'] if journal else 'received', attempts=attempts)
+        if attempts < request_max_attempts:
+            raise
+        logger.error(f"Giving up on the request after {attempts} failed attempts: {str(e)}")
+        metrics.inc('winlink_emails_total', outcome='error')
+        reply = {'type': 'error', 'recipient': request['message']['from'],
+                 'content': f"Failed to handle the request after {attempts} attempts |  Error: {str(e)}"}
+    if reply is not None and reply['type'] != 'deferred':
+        reply['key'] = request['key']
+        db.record_stage(request['key'], 'rendered', reply=reply)
+    return reply
 
+# Determine report type and build the reply with handle_weather_report
+def handle_email(message, journal_key=None):
     subject = message['subject']
     logger.info(f"Handling email with subject: {subject}")
 
+    command = subscriptions.parse_command(subject)
+    if command is not None:
+        return handle_subscription(message, command)
     if subject.lower().startswith('weather:'):
-        report_type = subject.split(':')[1].strip()  # Assumes the subject is in the form 'weather:type'
+        # Assumes the subject is in the form 'weather:type', optionally followed by ':compact' and a byte budget
+        options = [option.strip().lower() for option in subject.split(':')[1:]]
+        report_type = options[0]
+        compact = 'compact' in options[1:]
+        # isdecimal, not isdigit: superscripts like '²' are digits that int() rejects, and a budget of 0 means no budget
+        byte_budget = next((int(option) for option in options[1:] if option.isdecimal()), None) or None
         if report_type in ['daily', 'current', 'hourly']:
-            handle_weather_report(message, report_type)
+            return handle_weather_report(message, report_type, compact=compact, byte_budget=byte_budget, journal_key=journal_key)
         else:
             logger.error(f"Invalid weather report type: {report_type}")
     else:
         logger.info(f"Subject {subject} did not start with 'weather:'. Ignored.")
+    metrics.inc('winlink_emails_total', outcome='ignored')
+    return None
 
-# Call GPT functions with paresed email
-def handle_weather_report(message, report_type):
+# Call GPT functions with paresed email, returns the reply to send
+def handle_weather_report(message, report_type, compact=False, byte_budget=None, journal_key=None):
     body = extract_body(message)
     if body is None:
         logger.error("Failed to extract body from the message.")
-        send_error_email(message['from'], "Failed to extract the email body.")
-        return
+        metrics.inc('winlink_emails_total', outcome='error')
+        return {'type': 'error', 'recipient': message['from'], 'content': "Failed to extract the email body."}
     
     logger.info(f"Extracted body: {body}")
     try:
         location_data = body.strip()
-        forecast = gptWeather.generate_weather_report(location_content=location_data, oai_api_key=oai_api_key, oai_max_tokens=oai_max_tokens, weather_api_key=weather_api_key, type=report_type)
+        # Current conditions get the next upstream token ahead of daily and hourly reports
+        with upstream.priority(report_type):
+            forecast = gptWeather.generate_weather_report(location_content=location_data, oai_api_key=oai_api_key, oai_model=oai_model, oai_max_tokens=oai_max_tokens, weather_api_key=weather_api_key, type=report_type, compact=compact, byte_budget=byte_budget, journal_key=journal_key)
         if forecast is None:
             raise ValueError("Generated forecast is None.")
-        send_forecast_email(message['from'], forecast)
+        metrics.inc('winlink_emails_total', outcome='forecast')
+        return {'type': 'forecast', 'recipient': message['from'], 'content': forecast}
+    except upstream.CircuitOpenError as e:
+        # Leave the request unread so it is retried once the provider is back, without counting against the rate limit
+        logger.warning(f"Deferring the request from {message['from']}: {str(e)}")
+        db.update_last_request_time(message['from'], 0)
+        metrics.inc('winlink_emails_total', outcome='deferred')
+        return {'type': 'deferred', 'recipient': message['from'], 'content': str(e)}
     except Exception as e:
         logger.error(f"Failed to generate a valid forecast for {location_data} due to: {str(e)}")
-        send_error_email(message['from'], f"Failed to generate the weather report for: {location_data} |  Error: {str(e)}")
+        metrics.inc('winlink_emails_total', outcome='error')
+        return {'type': 'error', 'recipient': message['from'], 'content': f"Failed to generate the weather report for: {location_data} |  Error: {str(e)}"}
+
+# Add or remove the subscriptions of the sender, returns the reply to send
+def handle_subscription(message, command):
+    sender = message['from']
+    if command['command'] == 'unsubscribe':
+        removed = db.delete_subscriptions(sender, command['report_type'])
+        metrics.inc('winlink_emails_total', outcome='unsubscribed')
+        return {'type': 'notice', 'recipient': sender, 'content': f"Removed {removed} weather subscription(s)."}
+
+    location_content = (extract_body(message) or '').strip()
+    try:
+        location_data = gptWeather.resolve_location(location_content, oai_api_key, oai_model=oai_model, oai_max_tokens=oai_max_tokens) if location_content else None
+    except upstream.CircuitOpenError as e:
+        logger.warning(f"Deferring the subscription from {sender}: {str(e)}")
+        db.update_last_request_time(sender, 0)
+        metrics.inc('winlink_emails_total', outcome='deferred')
+        return {'type': 'deferred', 'recipient': sender, 'content': str(e)}
+    if location_data is None:
+        metrics.inc('winlink_emails_total', outcome='error')
+        return {'type': 'error', 'recipient': sender, 'content': f"Could not find the location for the subscription: {location_content}"}
+
+    subscription = subscriptions.subscribe(sender, command, location_content, location_data)
+    metrics.inc('winlink_emails_total', outcome='subscribed')
+    report_name = f"{subscription['report_type']}{' compact' if subscription['compact'] else ''}"
+    return {'type': 'notice', 'recipient': sender,
+            'content': f"You are subscribed to the {report_name} report for {location_content}, sent every day at "
+                       f"{subscription['send_time']} ({subscription['timezone']}). "
+                       f"Send weather:unsubscribe {subscription['report_type']} to stop it."}
+
+# Send a reply built by handle_request, returns False for a deferred request so it stays in the inbox
+def send_reply(reply):
+    if reply['type'] == 'deferred':
+        return False
+
+    # Once marked sending the reply counts as sent, a crash before "sent" must not lead to a second copy
+    key = reply.get('key')
+    if key:
+        db.record_stage(key, 'sending')
+    try:
+        if reply['type'] == 'forecast':
+            send_forecast_email(reply['recipient'], reply['content'])
+        elif reply['type'] == 'notice':
+            send_notice_email(reply['recipient'], reply['content'])
+        else:
+            send_error_email(reply['recipient'], reply['content'])
+    except Exception:
+        if key:
+            db.record_stage(key, 'rendered')  # The SMTP server did not take it, send it again with the retry
+        raise
+    if key:
+        db.record_stage(key, 'sent')
 
 # Send the forecast back to the requesting user
 def send_forecast_email(recipient, forecast):
@@ -154,13 +456,32 @@ def send_forecast_email(recipient, forecast):
 
     message.attach(MIMEText(forecast, 'plain'))
 
-    server = smtplib.SMTP(smtp_host, 587)
-    server.starttls()
-    server.login(smtp_username, smtp_password)
-    server.sendmail(smtp_username, recipient, message.as_string())
-    server.quit()
+    smtp_connection.sendmail(smtp_username, recipient, message.as_string())
     logger.info(f"Forecast sent to {recipient}.")
 
+# Send the scheduled subscription reports over one SMTP session, returns the subscriptions that were sent
+def send_scheduled_reports(reports):
+    sent = []
+    with smtp_connection.batch():
+        for subscription, report in reports:
+            try:
+                send_forecast_email(subscription['email'], report)
+                sent.append(subscription)
+            except Exception as e:
+                logger.error(f"Failed to send the scheduled report to {subscription['email']}: {str(e)}")
+    return sent
+
+# Send a confirmation (eg of a subscription) to the user
+def send_notice_email(recipient, notice):
+    message = MIMEMultipart()
+    message['From'] = smtp_username
+    message['To'] = recipient
+    message['Subject'] = 'Your Weather Subscription'
+    message.attach(MIMEText(notice, 'plain'))
+
+    smtp_connection.sendmail(smtp_username, recipient, message.as_string())
+    logger.info(f"Notice sent to {recipient}.")
+
 # Send error to the user if error occurs
 def send_error_email(recipient, error_message):
     if recipient is None:
@@ -173,9 +494,10 @@ def send_error_email(recipient, error_message):
     message['Subject'] = 'Error Processing Your Weather Request'
     message.attach(MIMEText(f"There was an error processing your weather request: {error_message}", 'plain'))
 
-    server = smtplib.SMTP(smtp_host, 587)
-    server.starttls()
-    server.login(smtp_username, smtp_password)
-    server.sendmail(smtp_username, recipient, message.as_string())
-    server.quit()
+    smtp_connection.sendmail(smtp_username, recipient, message.as_string())
     logger.info(f"Error notification sent to {recipient}.")
+
+
+# Requests are handled by a pool of workers and their replies sent from one thread
+request_pipeline = pipeline.Pipeline(handle_request, send_reply, workers=pipeline_workers, queue_size=pipeline_queue_size,
+                                     sender_context=smtp_connection.batch)
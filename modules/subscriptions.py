@@ -0,0 +1,149 @@
+import os
+import re
+import threading
+import time
+from datetime import datetime
+import pytz
+from .logger import logger
+from modules import db
+from modules import forecastCache
+from modules import gptWeather
+from modules import metrics
+from modules import openWeatherHelper
+from modules import upstream
+
+# Subscription Configuration
+subscription_check_interval = int(os.getenv('SUBSCRIPTION_CHECK_INTERVAL', '60'))
+subscription_grace = int(os.getenv('SUBSCRIPTION_GRACE', '3600'))  # A slot missed by more than this (eg while down) waits for the next day
+
+# weather:subscribe daily 06:00, optionally weather:subscribe daily:compact 06:00
+subscribe_pattern = re.compile(r'^\s*weather:\s*subscribe\s+(current|daily|hourly)(?:[:\s]+(compact))?\s+([01]?\d|2[0-3]):?([0-5]\d)\s*$', re.IGNORECASE)
+# weather:unsubscribe removes every subscription, weather:unsubscribe daily only that one
+unsubscribe_pattern = re.compile(r'^\s*weather:\s*unsubscribe(?:\s+(current|daily|hourly))?\s*$', re.IGNORECASE)
+
+# Function to parse a subscription command from the subject, returns None if the subject is not one
+def parse_command(subject):
+    match = subscribe_pattern.match(subject or '')
+    if match:
+        report_type, compact, hour, minute = match.groups()
+        return {'command': 'subscribe', 'report_type': report_type.lower(), 'compact': compact is not None,
+                'send_time': f"{int(hour):02d}:{minute}"}
+    match = unsubscribe_pattern.match(subject or '')
+    if match:
+        return {'command': 'unsubscribe', 'report_type': match.group(1).lower() if match.group(1) else None}
+    return None
+
+# Function to get the name of the timezone at a location, UTC where there is none (eg at sea)
+def timezone_name(lat, long):
+    try:
+        return openWeatherHelper.get_timezone(lat, long).zone
+    except ValueError:
+        return 'UTC'
+
+# Function to store the subscription of a user for a resolved location, the time is local to the location
+def subscribe(email, command, location_content, location_data):
+    lat, long = float(location_data['lat']), float(location_data['long'])
+    subscription = {
+        'email': email,
+        'report_type': command['report_type'],
+        'compact': int(command['compact']),
+        'send_time': command['send_time'],
+        'timezone': timezone_name(lat, long),
+        'lat': lat,
+        'long': long,
+        'units': location_data['units'],
+        'location': location_content,
+        'last_sent': time.time(),  # The first report goes out at the next slot
+    }
+    db.save_subscription(subscription)
+    logger.info(f"Subscribed {email} to the {command['report_type']} report at {command['send_time']} {subscription['timezone']}")
+    return subscription
+
+# Function to get today's slot of a subscription as a timestamp
+def slot_time(subscription, now):
+    timezone = pytz.timezone(subscription['timezone'])
+    today = datetime.fromtimestamp(now, timezone)
+    hour, minute = (int(part) for part in subscription['send_time'].split(':'))
+    return timezone.localize(datetime(today.year, today.month, today.day, hour, minute)).timestamp()
+
+# Function to find the subscriptions whose slot has come and not been sent yet, with the slot they are due for
+def due_subscriptions(subscriptions, now):
+    due = []
+    for subscription in subscriptions:
+        slot = slot_time(subscription, now)
+        if slot <= now < slot + subscription_grace and subscription['last_sent'] < slot:
+            due.append((subscription, slot))
+    return due
+
+# Function to build the reports of the due subscriptions, one fetch per grid cell and one render per cell,
+# report type, units and format, returns (subscription, report) pairs. Reports are rendered for the cell's
+# coordinates, the point the forecast was fetched for, so no subscriber sees another one's exact location
+def build_reports(subscriptions, weather_api_key):
+    cells = {}
+    for subscription in subscriptions:
+        cells.setdefault(forecastCache.grid_cell(subscription['lat'], subscription['long']), []).append(subscription)
+
+    reports = []
+    for cell, cell_subscriptions in cells.items():
+        # One OneCall response serves every report type, ask for it with the type that needs the freshest data
+        report_type = min((subscription['report_type'] for subscription in cell_subscriptions), key=lambda name: forecastCache.forecast_ttl[name])
+        try:
+            data = forecastCache.get_forecast(cell[0], cell[1], report_type, weather_api_key)
+        except Exception as e:
+            logger.error(f"Failed to fetch the forecast for subscriptions in cell {cell}: {str(e)}")
+            continue
+        if data is None:
+            continue
+
+        rendered = {}
+        for subscription in cell_subscriptions:
+            key = (subscription['report_type'], subscription['units'], subscription['compact'])
+            if key not in rendered:
+                rendered[key] = gptWeather.render_report(data, subscription['report_type'], cell[0], cell[1],
+                                                         subscription['units'], compact=bool(subscription['compact']))
+            reports.append((subscription, rendered[key]))
+    logger.info(f"Built {len(reports)} scheduled reports from {len(cells)} grid cells")
+    return reports
+
+# Function to send the reports that are due, deliver takes (subscription, report) pairs and returns the ones it sent
+def run_due(deliver, weather_api_key, now=None):
+    now = now if now is not None else time.time()
+    due = due_subscriptions(db.get_subscriptions(), now)
+    if not due:
+        return 0
+
+    # Claim each slot so only one instance sends it when several share the database
+    claim_keys = {f"subscription:{subscription['email']}:{subscription['report_type']}:{slot:.0f}": subscription for subscription, slot in due}
+    claimed = db.claim_messages(list(claim_keys))
+    subscriptions = [subscription for claim_key, subscription in claim_keys.items() if claim_key in claimed]
+
+    sent = []
+    try:
+        with metrics.stage('subscriptions'), upstream.priority(upstream.background_priority):
+            sent = deliver(build_reports(subscriptions, weather_api_key))
+        db.mark_subscriptions_sent([(subscription['email'], subscription['report_type']) for subscription in sent], now)
+    finally:
+        sent_keys = {(subscription['email'], subscription['report_type']) for subscription in sent}
+        finished = [claim_key for claim_key, subscription in claim_keys.items()
+                    if claim_key in claimed and (subscription['email'], subscription['report_type']) in sent_keys]
+        db.finish_claims(finished)
+        db.release_claims([claim_key for claim_key in claimed if claim_key not in finished])
+    metrics.inc('winlink_scheduled_reports_total', len(sent), outcome='sent')
+    metrics.inc('winlink_scheduled_reports_total', len(subscriptions) - len(sent), outcome='failed')
+    logger.info(f"Sent {len(sent)} of {len(subscriptions)} due scheduled reports")
+    return len(sent)
+
+# Function to check for due subscriptions in the background
+def run_scheduler(deliver, weather_api_key, interval=subscription_check_interval):
+    while True:
+        try:
+            run_due(deliver, weather_api_key)
+        except Exception as e:
+            logger.error(f"Error sending scheduled reports: {str(e)}")
+        time.sleep(interval)
+
+# Function to start the subscription scheduler thread
+def start_scheduler(deliver, weather_api_key, interval=subscription_check_interval):
+    thread = threading.Thread(target=run_scheduler, args=(deliver, weather_api_key, interval), name="subscription-scheduler", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,205 @@
+import os
+import heapq
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+import requests
+from .logger import logger
+from modules import connections
+from modules import metrics
+
+# Upstream Configuration
+max_retries = int(os.getenv('UPSTREAM_MAX_RETRIES', '3'))
+backoff_base = float(os.getenv('UPSTREAM_BACKOFF_BASE', '1'))
+backoff_max = float(os.getenv('UPSTREAM_BACKOFF_MAX', '30'))
+circuit_failures = int(os.getenv('CIRCUIT_FAILURES', '5'))
+circuit_reset = float(os.getenv('CIRCUIT_RESET', '60'))
+
+# Requests per minute allowed for each provider, 0 means no pacing
+provider_rates = {
+    'openai': float(os.getenv('OAI_RATE_LIMIT', '60')),
+    'openweather': float(os.getenv('WEATHER_RATE_LIMIT', '60')),
+}
+
+# Lower numbers are served first when requests wait for a token
+report_priorities = {'current': 0, 'daily': 1, 'hourly': 1}
+default_priority = 1
+background_priority = 2
+
+_context = threading.local()
+
+# Raised instead of calling a provider that is failing, callers serve from cache or leave the request queued
+class CircuitOpenError(Exception):
+    pass
+
+# Token bucket that hands out tokens by priority, then in arrival order
+class TokenBucket:
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1.0, rate_per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waiting = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority=default_priority):
+        if self.rate <= 0:
+            return
+        with self.condition:
+            ticket = (priority, next(self.counter))
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while True:
+                    self.refill()
+                    if self.waiting[0] == ticket and self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    # Only the first waiter can be woken by a new token, the rest wait to be notified
+                    self.condition.wait((1 - self.tokens) / self.rate if self.waiting[0] == ticket else None)
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    # Hold back every waiting request for a number of seconds, used when the provider reports its quota exceeded
+    def pause(self, seconds):
+        with self.condition:
+            self.refill()
+            self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+# Circuit breaker that opens after repeated failures and lets one trial request through after the reset timeout
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=circuit_failures, reset_timeout=circuit_reset):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened >= self.reset_timeout and not self.trial_running:
+                self.trial_running = True
+                logger.info(f"Circuit for {self.name} half open, sending a trial request")
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.opened is not None:
+                logger.info(f"Circuit for {self.name} closed")
+            self.failures = 0
+            self.opened = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened is not None or self.failures >= self.failure_threshold:
+                if self.opened is None:
+                    logger.warning(f"Circuit for {self.name} opened after {self.failures} failures")
+                self.opened = time.monotonic()
+
+    def is_open(self):
+        with self.lock:
+            return self.opened is not None
+
+buckets = {provider: TokenBucket(rate) for provider, rate in provider_rates.items()}
+breakers = {provider: CircuitBreaker(provider) for provider in provider_rates}
+
+# Function to get the priority of the upstream calls made by this thread
+def current_priority():
+    return getattr(_context, 'priority', default_priority)
+
+# Use the priority of a report type (or a number) for the upstream calls made by this thread
+@contextmanager
+def priority(report_type):
+    previous = current_priority()
+    _context.priority = report_priorities.get(report_type, default_priority) if isinstance(report_type, str) else report_type
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+# Function to read the Retry-After header in seconds, either a number or an HTTP date
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Function to get the jittered exponential backoff for a retry attempt
+def backoff(attempt):
+    return random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+
+# Function to send a request to a provider, paced by its token bucket, retried on 429/5xx and guarded by its breaker
+def request(provider, method, url, **kwargs):
+    breaker = breakers[provider]
+    bucket = buckets[provider]
+    if not breaker.allow():
+        metrics.inc('winlink_upstream_errors_total', provider=provider, reason='circuit_open')
+        raise CircuitOpenError(f"{provider} is unavailable, circuit open")
+
+    send = connections.http_post if method.upper() == 'POST' else connections.http_get
+    for attempt in range(max_retries + 1):
+        bucket.acquire(current_priority())
+        try:
+            with metrics.timed('winlink_upstream_duration_seconds', provider=provider):
+                response = send(url, **kwargs)
+        except requests.RequestException as e:
+            metrics.inc('winlink_upstream_errors_total', provider=provider, reason=type(e).__name__)
+            breaker.record_failure()
+            if not breaker.allow():
+                raise CircuitOpenError(f"{provider} is unavailable after {str(e)}") from e
+            if attempt == max_retries:
+                raise
+            delay = backoff(attempt)
+            logger.warning(f"{provider} request failed ({str(e)}), retrying in {delay:.1f} seconds")
+            time.sleep(delay)
+            continue
+
+        metrics.inc('winlink_upstream_requests_total', provider=provider, status=response.status_code)
+        if response.status_code >= 500 or response.status_code == 429:
+            metrics.inc('winlink_upstream_errors_total', provider=provider, reason=f"status_{response.status_code}")
+        if response.status_code >= 500:
+            breaker.record_failure()
+            if not breaker.allow():
+                raise CircuitOpenError(f"{provider} is unavailable after status {response.status_code}")
+        else:
+            # A 429 still means the provider is up, only the quota is exhausted
+            breaker.record_success()
+            if response.status_code != 429:
+                return response
+        if attempt == max_retries:
+            return response
+
+        delay = retry_after(response)
+        delay = backoff(attempt) if delay is None else min(delay, backoff_max * 4) + random.uniform(0, backoff_base)
+        logger.warning(f"{provider} returned {response.status_code}, retrying in {delay:.1f} seconds")
+        if response.status_code == 429 and bucket.rate > 0:
+            # Over quota: hold back every request to this provider, the retry waits for its token like the rest
+            bucket.pause(delay)
+        else:
+            time.sleep(delay)
+    return response